@@ -12,11 +12,20 @@ from dbsetup import modules_from_config
 
 def session():
     """
-    Create a session based on the one set up by the dbsetup.init.
+    Create a session based on the one set up by the dbsetup.init, or for the
+    current tenant inside a :func:`pp.db.tenants.tenant` block.
 
     :returns: An instance of the Session class.
 
     """
+    from dbsetup import check_fork
+    from tenants import current_tenant
+    check_fork()
+    name = current_tenant()
+    if name is not None:
+        from dbsetup import engines
+        assert engines is not None, "Please setup the registry with dbsetup.init_registry before using a tenant"
+        return engines.session(name)
     from dbsetup import Session
     assert Session, "Please setup the database before attempting to use the session"
     return Session()
@@ -31,8 +40,17 @@ def metadata():
 
 def engine():
     """
-    Return SQLAlchemy engine, used for introspecting table definitions
+    Return SQLAlchemy engine, used for introspecting table definitions. Inside a
+    :func:`pp.db.tenants.tenant` block this is the tenant's engine.
     """
+    from dbsetup import check_fork
+    from tenants import current_tenant
+    check_fork()
+    name = current_tenant()
+    if name is not None:
+        from dbsetup import engines
+        assert engines is not None, "Please setup the registry with dbsetup.init_registry before using a tenant"
+        return engines.engine(name)
     from dbsetup import engine
     assert engine, "Please setup the database before attempting to use the engine"
     return engine
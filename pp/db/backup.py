@@ -3,23 +3,184 @@ Database backup utils
 """
 import subprocess
 import datetime
+import errno
 import gzip
+import hashlib
 import logging
 import md5
 import json
+import multiprocessing
 import os
+import re
 import contextlib
+import copy
+import shutil
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
 
 from path import path
 import dateutil.parser
+import sqlalchemy
 from sqlalchemy import text
 
+from pp.db import dbsetup
+
 log = logging.getLogger(__name__)
 
+# Algorithm used for the content checksums stored in the metadata sidecar.
+CHECKSUM_ALGORITHM = 'sha256'
+
+# Read size used when streaming dump files for checksums and verification.
+CHUNK_SIZE = 64 * 1024
+
+# Seconds to keep retrying the rename of a swapped in postgresql database while
+# terminated connections to it are still exiting.
+SWAP_TIMEOUT = 10
+
+# SQLSTATE for "database is being accessed by other users"
+_PG_OBJECT_IN_USE = '55006'
+
+# Settings holding a list, stored in pg_db_role_setting as quoted list items
+_PG_LIST_SETTINGS = ('search_path', 'temp_tablespaces', 'session_preload_libraries',
+                     'shared_preload_libraries', 'local_preload_libraries')
+
+# Magic number every gzip member starts with
+_GZIP_MAGIC = b'\x1f\x8b'
+
 
 class BackupError(Exception):
     pass
 
+
+class BackupCancelled(BackupError):
+    """ Raised when a dump or load is stopped through :meth:`BackupProgress.cancel`
+    """
+
+
+class BackupProgress(object):
+    """ Progress reporting and cooperative cancellation for dumps and loads.
+
+        The callback is called with this object when the dump moves on to a new table,
+        and otherwise at most every `interval` seconds. Call :meth:`cancel` (eg. from
+        another thread) to stop the operation: the dump or load raises
+        :class:`BackupCancelled` at the next line and removes any partially written file.
+        Once a dump is written its checksum, as returned by :func:`checksum_file`, is
+        left in `checksum`.
+    """
+    # Lines which start a table's data in sqlite .dump and pg_dump output
+    _data_re = re.compile(r'^(INSERT INTO|COPY)\s+"?([\w.]+)"?', re.I)
+
+    def __init__(self, callback=None, interval=1.0, cancel_event=None):
+        """
+        :param callback:      called with this object on each progress update
+        :param interval:      minimum seconds between updates within a table
+        :param cancel_event:  threading.Event to use as the cancellation token, so one
+                              token can be shared between several operations
+        """
+        self.callback = callback
+        self.interval = interval
+        self.cancel_event = cancel_event or threading.Event()
+        self.bytes = 0
+        self.rows = 0
+        self.tables = []
+        self.started = None
+        self.finished = None
+        self.checksum = None
+        self._last_report = 0
+        self._in_copy = False
+
+    @property
+    def table(self):
+        """ Table currently being dumped or loaded
+        """
+        return self.tables[-1] if self.tables else None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """ Bytes per second of uncompressed dump data
+        """
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed else 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise BackupCancelled("Cancelled after {} bytes".format(self.bytes))
+
+    def start(self):
+        self.started = time.time()
+        self._report()
+
+    def finish(self):
+        self.finished = time.time()
+        self._report()
+
+    def line(self, line):
+        """ Account for one line of dump data
+        """
+        self.check_cancelled()
+        self.bytes += len(line)
+        table = self.table
+        if self._in_copy:
+            if line.startswith('\\.'):
+                self._in_copy = False
+            else:
+                self.rows += 1
+        else:
+            match = self._data_re.match(line)
+            if match:
+                if match.group(1).upper() == 'COPY':
+                    self._in_copy = True
+                else:
+                    self.rows += 1
+                if match.group(2) != table:
+                    self.tables.append(match.group(2))
+        if self.table != table or time.time() - self._last_report >= self.interval:
+            self._report()
+
+    def _report(self):
+        self._last_report = time.time()
+        if self.callback:
+            self.callback(self)
+
+    def child(self):
+        """ Progress for one of several streams run in parallel. It shares this
+            progress' cancellation token; use :meth:`merge` to add its counts back in.
+        """
+        return BackupProgress(interval=self.interval, cancel_event=self.cancel_event)
+
+    def merge(self, child):
+        """ Add the counts of a finished child progress to this one
+        """
+        self.bytes += child.bytes
+        self.rows += child.rows
+        self.tables.extend(t for t in child.tables if t not in self.tables)
+        self._report()
+
+    def as_dict(self):
+        """ Summary stats as stored in the metadata sidecar
+        """
+        return {'bytes': self.bytes,
+                'rows': self.rows,
+                'tables': list(self.tables),
+                'seconds': round(self.elapsed, 3),
+                'bytes_per_second': round(self.throughput, 1),
+                }
+
 class DatabaseBackupAPI(object):
     """ One-stop-shop for backup and restore of databases
     """
@@ -41,16 +202,60 @@ class DatabaseBackupAPI(object):
     def _meta_filename(self, dump_file):
             return dump_file.dirname() / (dump_file.basename() + ".meta")
 
-    def dump(self, file_metadata=None):
-        """ Dump database to backup directory
+    def _read_metadata(self, dump_file):
+        meta_file = self._meta_filename(dump_file)
+        if meta_file.isfile():
+            return json.loads(meta_file.text())
+        return {}
+
+    def _table_names(self, tables):
+        """ Resolve table names or declarative classes to table names, checking they are
+            known to dbsetup or the metadata, and order them so referenced tables come first.
+        """
+        names = []
+        for table in tables:
+            if not isinstance(table, basestring):
+                table = getattr(table, '__tablename__', None) or table.__table__.name
+            if table not in names:
+                names.append(table)
+        known = set(dbsetup.bases) | set(dbsetup.tables)
+        if isinstance(self.metadata, sqlalchemy.MetaData):
+            known.update(self.metadata.tables)
+            order = [t.name for t in self.metadata.sorted_tables]
+            names.sort(key=lambda n: order.index(n) if n in order else len(order))
+        unknown = [n for n in names if known and n not in known]
+        if unknown:
+            raise BackupError("Unknown tables: {}".format(', '.join(unknown)))
+        return names
+
+    def dump(self, file_metadata=None, progress=None, tables=None, jobs=None):
+        """ Dump database to backup directory. A checksum of the dump file is stored
+            under the 'checksum' key of the metadata sidecar, and the dump stats under 'stats'.
 
             :param file_metadata: Mark this backup with custom metadata which is returned as part of
                                   restore_points
+            :param progress:      :class:`BackupProgress` to report progress to and cancel with
+            :param tables:        names (as in dbsetup.tables and dbsetup.bases) or classes of
+                                  the tables to dump, rather than the whole database. The names
+                                  are stored under 'tables' in the metadata sidecar, and loading
+                                  the restore point only replaces those tables.
+            :param jobs:          tables to dump at once, see :func:`dump_database`
         """
-        dump_file = dump_database(self.engine, self.backup_dir)
-        if file_metadata:
-            meta_file = self._meta_filename(dump_file)
-            meta_file.write_text(json.dumps(file_metadata))
+        progress = progress or BackupProgress()
+        md = dict(file_metadata or {})
+        if tables is not None:
+            tables = self._table_names(tables)
+            if not tables:
+                raise BackupError("No tables to dump")
+            md['tables'] = tables
+            dump_file = dump_database(self.engine, self.backup_dir, progress=progress,
+                                      tables=tables, jobs=jobs)
+        else:
+            dump_file = dump_database(self.engine, self.backup_dir, progress=progress)
+        # Dump functions from outside this module may not checksum as they write
+        md['checksum'] = progress.checksum or checksum_file(dump_file)
+        md['stats'] = progress.as_dict()
+        self._meta_filename(dump_file).write_text(json.dumps(md))
         return dump_file
 
     def get_id(self, dump_file):
@@ -64,9 +269,7 @@ class DatabaseBackupAPI(object):
         """
         res = []
         for f in self.backup_dir.files("*.gz") :
-            md = {}
-            if self._meta_filename(f).isfile():
-                md = json.loads(self._meta_filename(f).text())
+            md = self._read_metadata(f)
             res.append({'id': self.get_id(f), 
                         'timestamp':f.basename().split('.')[-2], 
                         'path': f,
@@ -86,49 +289,334 @@ class DatabaseBackupAPI(object):
             return dateutil.parser.parse(self._last_restore_file.text())
         return None
         
-    def load(self, restore_point_id):
-        """ Load database from given restore point, and save a marker for when we did this
-        """
+    def _get_restore_point(self, restore_point_id):
         backup = [i for i in self.restore_points if i['id'] == restore_point_id]
         if not backup:
             raise BackupError("Unknown restore point")
-        backup = backup[0]
-        load_database(self.engine, self.metadata, backup['path'])
+        return backup[0]
+
+    def verify(self, restore_point_ids=None, processes=None):
+        """ Check the given restore points are intact. Each dump file is checked against
+            the checksum recorded when it was dumped (if any) and decompressed in full to
+            catch truncated or corrupt files. Files are checked concurrently in a process pool.
+
+            :param restore_point_ids: restore point IDs to check, defaults to all of them
+            :param processes:         size of the process pool, defaults to the CPU count
+            :returns:   dict of restore point ID -> error message, or None if the file is good
+        """
+        if restore_point_ids is None:
+            backups = self.restore_points
+        else:
+            backups = [self._get_restore_point(i) for i in restore_point_ids]
+        jobs = [(b['path'], b['metadata'].get('checksum')) for b in backups]
+        if len(jobs) > 1 and processes != 1:
+            pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(jobs)))
+            try:
+                errors = pool.map(_verify_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = map(_verify_job, jobs)
+        return dict((b['id'], err) for b, err in zip(backups, errors))
+
+    def load(self, restore_point_id, verify=True, swap=False, progress=None):
+        """ Load database from given restore point, and save a marker for when we did this.
+            The load stats are stored under 'load_stats' in the metadata sidecar.
+
+            :param verify:   check the dump file is intact before touching the database
+            :param swap:     load into a staging database and swap it in, rather than
+                             dropping the live database first. On PostgreSQL the owner,
+                             settings, GRANTs and COMMENT of the live database are copied
+                             over, but not its encoding, locale or tablespace. See
+                             :func:`swap_load_database`
+            :param progress: :class:`BackupProgress` to report progress to and cancel with
+
+            Restore points of selected tables only replace those tables, in a single
+            transaction, so `swap` doesn't apply to them. See :func:`load_tables_database`
+        """
+        backup = self._get_restore_point(restore_point_id)
+        if verify:
+            err = verify_dump_file(backup['path'], backup['metadata'].get('checksum'))
+            if err:
+                raise BackupError("Restore point {} is corrupt: {}".format(restore_point_id, err))
+        progress = progress or BackupProgress()
+        tables = backup['metadata'].get('tables')
+        if tables:
+            load_tables_database(self.engine, backup['path'], tables, progress=progress)
+        elif swap:
+            swap_load_database(self.engine, backup['path'], progress=progress)
+        else:
+            load_database(self.engine, self.metadata, backup['path'], progress=progress)
         self._last_restore_file.write_text(datetime.datetime.now().isoformat())
+        md = dict(backup['metadata'], load_stats=progress.as_dict())
+        self._meta_filename(backup['path']).write_text(json.dumps(md))
+
+
+class _ChecksumWriter(object):
+    """ File object wrapper which checksums the bytes as they are written
+    """
+    def __init__(self, fh, algorithm=CHECKSUM_ALGORITHM):
+        self.fh = fh
+        self.algorithm = algorithm
+        self.digest = hashlib.new(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+    def checksum(self):
+        """ :returns:   dict of 'algorithm', 'digest' and 'size' as for :func:`checksum_file`
+        """
+        return {'algorithm': self.algorithm, 'digest': self.digest.hexdigest(), 'size': self.size}
+
+
+def checksum_file(dump_file, algorithm=CHECKSUM_ALGORITHM):
+    """ Stream a file through a hashlib checksum algorithm
+
+        :returns:   dict of 'algorithm', 'digest' and 'size' as stored in the metadata sidecar
+    """
+    digest = hashlib.new(algorithm)
+    size = 0
+    with open(dump_file, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return {'algorithm': algorithm, 'digest': digest.hexdigest(), 'size': size}
+
+
+def verify_dump_file(dump_file, checksum=None):
+    """ Check a dump file against its recorded checksum and that it decompresses cleanly
 
+        :param checksum:  checksum dict as returned by :func:`checksum_file`, or None to
+                          only check the gzip stream
+        :returns:   error message, or None if the file is good
+    """
+    dump_file = path(dump_file)
+    if not dump_file.isfile():
+        return "missing file {}".format(dump_file)
+    if checksum:
+        actual = checksum_file(dump_file, checksum['algorithm'])
+        if actual['size'] != checksum['size']:
+            return "size mismatch: expected {} bytes, found {}".format(checksum['size'], actual['size'])
+        if actual['digest'] != checksum['digest']:
+            return "checksum mismatch: expected {}, found {}".format(checksum['digest'], actual['digest'])
+    with open(dump_file, 'rb') as fh:
+        # gzip reads an empty file as an empty stream
+        if fh.read(len(_GZIP_MAGIC)) != _GZIP_MAGIC:
+            return "unreadable gzip stream: no gzip member"
+    try:
+        with contextlib.closing(gzip.open(dump_file)) as fh:
+            while fh.read(CHUNK_SIZE):
+                pass
+    except (IOError, EOFError, zlib.error) as e:
+        return "unreadable gzip stream: {}".format(e)
+    return None
+
+
+def _verify_job(args):
+    """ Process pool entry point for :meth:`DatabaseBackupAPI.verify`
+    """
+    return verify_dump_file(*args)
+
+
+@contextlib.contextmanager
+def _cleanup_on_error(proc, partial_file=None):
+    """ Kill the dump/load subprocess and remove any partially written file if the
+        block fails or is cancelled.
+    """
+    try:
+        yield
+    except Exception:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if partial_file is not None:
+            path(partial_file).remove_p()
+        raise
+
+
+def _dump_stream(proc, dump_file, progress):
+    """ Stream the stdout of a dump subprocess into a gzipped dump file. The dump is
+        written to a '.partial' file which is only renamed into place once complete.
+        The compressed bytes are checksummed on the way into progress.checksum.
+    """
+    partial_file = dump_file + '.partial'
+    progress.start()
+    with _cleanup_on_error(proc, partial_file):
+        with open(partial_file, 'wb') as fh:
+            writer = _ChecksumWriter(fh)
+            with contextlib.closing(gzip.GzipFile(os.path.basename(dump_file), 'wb', fileobj=writer)) as zip_fh:
+                for line in proc.stdout:
+                    progress.line(line)
+                    zip_fh.write(line)
+        if proc.wait():
+            raise BackupError("Dump to {} failed with exit code {}".format(dump_file, proc.returncode))
+    os.rename(partial_file, dump_file)
+    progress.checksum = writer.checksum()
+    progress.finish()
+
+
+def _load_stream(proc, dump_file, progress, transform=None):
+    """ Stream a gzipped dump file into the stdin of a load subprocess
 
-def dump_sqlite(engine, backup_dir):
+        :param transform:  optional generator function which is given the dump file's
+                           lines and yields the lines to load
+        :returns:   subprocess exit code
+    """
+    progress.start()
+    with _cleanup_on_error(proc):
+        with gzip.open(dump_file) as dump_fh:
+            lines = transform(dump_fh) if transform else dump_fh
+            for line in lines:
+                progress.line(line)
+                try:
+                    proc.stdin.write(line)
+                except IOError as e:
+                    # The process bailed out early, its exit code says why
+                    if e.errno != errno.EPIPE:
+                        raise
+                    break
+        proc.communicate()
+    progress.finish()
+    return proc.returncode
+
+
+def _dump_name(name, tables=None):
+    """ Dump file name for a database, eg. dbname.dump.20121004-0300.gz. Dumps of
+        selected tables are named after a hash of the table names, eg.
+        dbname.tables-1a2b3c4d.dump.20121004-0300.gz
+    """
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M')
+    if tables:
+        name = '{}.tables-{}'.format(name, md5.new(','.join(sorted(tables))).hexdigest()[:8])
+    return '{}.dump.{}.gz'.format(name, timestamp)
+
+
+def _sqlite_table_dump(table):
+    """ sqlite3 shell commands printing the SQL to recreate one table: its CREATE TABLE,
+        the rows as INSERTs, then its indexes and triggers. The shell's own '.dump <table>'
+        can't be used as it takes a LIKE pattern, which matches other tables when the
+        name has an underscore in it.
+    """
+    name = table.replace("'", "''")
+    return ('.mode list\n'
+            'SELECT sql || \';\' FROM sqlite_master WHERE type = \'table\' AND name = \'{name}\';\n'
+            '.mode insert "{table}"\n'
+            'SELECT * FROM "{ident}";\n'
+            '.mode list\n'
+            'SELECT sql || \';\' FROM sqlite_master WHERE tbl_name = \'{name}\' '
+            'AND type IN (\'index\', \'trigger\') AND sql IS NOT NULL;\n'
+            ).format(name=name, table=table, ident=table.replace('"', '""'))
+
+
+def dump_sqlite(engine, backup_dir, progress=None, tables=None, jobs=None):
     """ This is the equivalent of:
         echo '.dump' | sqlite3 dbfile | gzip -c > backup_dir/dbfile.dump.20121004-0300.gz
 
+        Selected tables are dumped one after another inside a single read transaction,
+        so they come from one snapshot of the database. SQLite can't share a snapshot
+        between connections, so `jobs` is ignored.
+
         :returns:   path to new dump file
     """
     backup_dir = path(backup_dir)
     dbfile = path(engine.url.database)
-    dump_name = '{}.dump.{}.gz'.format(dbfile.basename(), datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-    dump_file = backup_dir / dump_name
+    dump_file = backup_dir / _dump_name(dbfile.basename(), tables)
     log.info("Dumping SQLite database to {}".format(dump_file))
-    with gzip.open(dump_file, 'wb') as zip_fh:
-        cmd = ['sqlite3', dbfile]
-        sqlite = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, _ = sqlite.communicate(".dump\n")
-        for line in stdout:
-            zip_fh.write(line)
+    if tables:
+        sqlite = subprocess.Popen(['sqlite3', '-bail', dbfile], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        sqlite.stdin.write(".headers off\nBEGIN;\n")
+        for table in tables:
+            sqlite.stdin.write(_sqlite_table_dump(table))
+        sqlite.stdin.write("COMMIT;\n")
+    else:
+        sqlite = subprocess.Popen(['sqlite3', dbfile], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        sqlite.stdin.write(".dump\n")
+    sqlite.stdin.close()
+    _dump_stream(sqlite, dump_file, progress or BackupProgress())
     return dump_file
 
 
-def load_sqlite(engine, dump_file):
+def load_sqlite(engine, dump_file, progress=None):
     """ Load a sqlite dump file into the given sqla engine
     """
     dbfile = engine.url.database
     log.warn("Loading SQLite database from {}. This will destroy all existing data".format(dump_file))
-    cmd = ['sqlite3', dbfile]
+    _sqlite_load_file(dbfile, dump_file, progress=progress)
+
+
+def _sqlite_load_file(dbfile, dump_file, args=(), progress=None):
+    """ Pipe a sqlite dump file into the sqlite3 shell for the given db file
+
+        :returns:   sqlite3 exit code
+    """
+    cmd = ['sqlite3'] + list(args) + [dbfile]
     sqlite = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-    with gzip.open(dump_file) as dump_file:
-        for line in dump_file:
-            log.debug(line)
-            sqlite.stdin.write(line)
-    sqlite.communicate()
+    return _load_stream(sqlite, dump_file, progress or BackupProgress())
+
+
+# Transaction control lines of a sqlite .dump, left out when loading it inside
+# a transaction of our own
+_SQLITE_DUMP_CONTROL = frozenset(['PRAGMA foreign_keys=OFF;', 'BEGIN TRANSACTION;', 'COMMIT;'])
+
+
+def load_tables_sqlite(engine, dump_file, tables, progress=None):
+    """ Replace the given tables with those in a sqlite dump of selected tables. The
+        tables are dropped and reloaded in a single transaction, which is rolled back
+        if any of the load fails. Other tables are left alone.
+    """
+    dbfile = engine.url.database
+    log.warn("Loading tables {} into SQLite database from {}".format(', '.join(tables), dump_file))
+
+    def transform(lines):
+        yield 'PRAGMA foreign_keys=OFF;\n'
+        yield 'BEGIN;\n'
+        for table in reversed(tables):
+            yield 'DROP TABLE IF EXISTS "{}";\n'.format(table)
+        for line in lines:
+            if line.rstrip('\r\n') not in _SQLITE_DUMP_CONTROL:
+                yield line
+        yield 'COMMIT;\n'
+
+    sqlite = subprocess.Popen(['sqlite3', '-bail', dbfile], stdin=subprocess.PIPE)
+    if _load_stream(sqlite, dump_file, progress or BackupProgress(), transform):
+        raise BackupError("Failed loading tables from {} into {}".format(dump_file, dbfile))
+
+
+def swap_load_sqlite(engine, dump_file, progress=None):
+    """ Load a sqlite dump file into a staging copy next to the live db file, check it
+        and then rename it over the live file. Readers and writers carry on using the
+        live database until the rename.
+    """
+    dbfile = path(engine.url.database)
+    staging = dbfile + '.restore'
+    if staging.isfile():
+        staging.remove()
+    log.info("Loading SQLite database from {} into staging file {}".format(dump_file, staging))
+    try:
+        if _sqlite_load_file(staging, dump_file, args=['-bail'], progress=progress):
+            raise BackupError("Failed loading {} into {}".format(dump_file, staging))
+        check = subprocess.Popen(['sqlite3', staging, 'PRAGMA integrity_check;'],
+                                 stdout=subprocess.PIPE)
+        stdout, _ = check.communicate()
+        if check.returncode or stdout.strip() != 'ok':
+            raise BackupError("Integrity check failed on {}: {}".format(staging, stdout.strip()))
+    except Exception:
+        staging.remove_p()
+        raise
+    log.warn("Swapping restored SQLite database {} into place at {}".format(staging, dbfile))
+    # Pooled connections still have the old file open. The old file's WAL must go
+    # before the rename, or it would be replayed onto the restored database.
+    engine.dispose()
+    for suffix in ('-wal', '-shm'):
+        (dbfile + suffix).remove_p()
+    os.rename(staging, dbfile)
 
 
 def drop_generic(engine, metadata):
@@ -138,40 +626,275 @@ def drop_generic(engine, metadata):
     #       referenced in this particular metadata obj won't be dropped
     metadata.drop_all(engine)
 
-def dump_postgresql(engine, backup_dir):
+def _pg_dump(engine, args, dump_file, progress):
+    cmd = ['pg_dump', '-v', '-h', 'localhost', '-U', engine.url.username] + list(args) + [engine.url.database]
+    env = dict(os.environ)
+    env['PGPASSWORD'] = engine.url.password
+    pgdump = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE)
+    _dump_stream(pgdump, dump_file, progress)
+
+
+def dump_postgresql(engine, backup_dir, progress=None, tables=None, jobs=None):
     """ This is the equivalent of:
         pgdump dbname | gzip -c > backup_dir/dbname.dump.20121004-0300.gz
 
+        Selected tables are dumped by up to `jobs` pg_dump processes at once, all reading
+        the same snapshot exported from a repeatable read transaction held open for the
+        length of the dump. Their output is joined into one dump file in table order.
+
         :returns:   path to new dump file
     """
     backup_dir = path(backup_dir)
-    dbname = engine.url.database
-    dump_name = '{}.dump.{}.gz'.format(dbname, datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-    dump_file = backup_dir / dump_name
+    dump_file = backup_dir / _dump_name(engine.url.database, tables)
     log.info("Dumping Postgresql database to {}".format(dump_file))
-    cmd = ['pg_dump', '-v', '-h', 'localhost', '-U', engine.url.username, dbname]
-    env = dict(os.environ)
-    env['PGPASSWORD'] = engine.url.password
-    with gzip.open(dump_file, 'wb') as dump_fh:
-        pgdump = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE)
-        stdout, _ = pgdump.communicate()
-        [dump_fh.write(line) for line in stdout]
-        
+    progress = progress or BackupProgress()
+    if not tables:
+        _pg_dump(engine, [], dump_file, progress)
+        return dump_file
+
+    parts = [path('{}.{}.part'.format(dump_file, i)) for i in range(len(tables))]
+    children = [progress.child() for _ in tables]
+    merge_lock = threading.Lock()
+    snapshot_engine = sqlalchemy.create_engine(engine.url, poolclass=sqlalchemy.pool.NullPool)
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(tables)))
+    partial_file = dump_file + '.partial'
+    try:
+        with contextlib.closing(snapshot_engine.connect()) as connection:
+            txn = connection.begin()
+            connection.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            snapshot = connection.scalar('SELECT pg_export_snapshot()')
+
+            def dump_table(i):
+                args = ['--snapshot=' + snapshot, '--table="{}"'.format(tables[i])]
+                _pg_dump(engine, args, parts[i], children[i])
+                with merge_lock:
+                    progress.merge(children[i])
+
+            progress.start()
+            pool.map(dump_table, range(len(tables)))
+            txn.rollback()
+
+        with open(partial_file, 'wb') as out_fh:
+            writer = _ChecksumWriter(out_fh)
+            # Concatenated gzip members are a valid gzip file
+            for part in parts:
+                with open(part, 'rb') as in_fh:
+                    shutil.copyfileobj(in_fh, writer, CHUNK_SIZE)
+        os.rename(partial_file, dump_file)
+        progress.checksum = writer.checksum()
+        progress.finish()
+    except Exception:
+        path(partial_file).remove_p()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+        snapshot_engine.dispose()
+        for part in parts:
+            part.remove_p()
     return dump_file
 
-def load_postgresql(engine, dump_file):
+def load_postgresql(engine, dump_file, progress=None):
     dbname = engine.url.database
     log.warn("Loading Postgresql database from {}. This will destroy all existing data".format(dump_file))
     log.warn(engine.url.__dict__)
-    cmd = ['psql', '--host=localhost', '--username=' + engine.url.username, dbname]
+    _psql_load_file(engine, dbname, dump_file, progress=progress)
+
+
+def _psql_load_file(engine, dbname, dump_file, args=(), progress=None):
+    """ Pipe a postgresql dump file into psql for the given database name, using the
+        credentials from the engine.
+
+        :returns:   psql exit code
+    """
+    cmd = ['psql', '--host=localhost', '--username=' + engine.url.username] + list(args) + [dbname]
     env = dict(os.environ)
     env['PGPASSWORD'] = engine.url.password
     log.warn(cmd)
     psql = subprocess.Popen(cmd, stdin=subprocess.PIPE, env=env)
-    with gzip.open(dump_file) as dump_file:
-        for line in dump_file:
-            psql.stdin.write(line)
-    psql.communicate()
+    return _load_stream(psql, dump_file, progress or BackupProgress())
+
+
+def load_tables_postgresql(engine, dump_file, tables, progress=None):
+    """ Replace the given tables with those in a postgresql dump of selected tables,
+        in a single transaction. The tables are dropped without CASCADE, so tables
+        with foreign keys to them must be part of the same dump.
+    """
+    dbname = engine.url.database
+    log.warn("Loading tables {} into Postgresql database from {}".format(', '.join(tables), dump_file))
+
+    def transform(lines):
+        for table in reversed(tables):
+            yield 'DROP TABLE IF EXISTS "{}";\n'.format(table)
+        for line in lines:
+            yield line
+
+    cmd = ['psql', '--host=localhost', '--username=' + engine.url.username,
+           '--set=ON_ERROR_STOP=1', '--single-transaction', dbname]
+    env = dict(os.environ)
+    env['PGPASSWORD'] = engine.url.password
+    psql = subprocess.Popen(cmd, stdin=subprocess.PIPE, env=env)
+    if _load_stream(psql, dump_file, progress or BackupProgress(), transform):
+        raise BackupError("Failed loading tables from {} into {}".format(dump_file, dbname))
+
+
+def _admin_engine(engine, database='postgres'):
+    """ Engine for the maintenance database on the same server, used for
+        CREATE/DROP/ALTER DATABASE which can't be run against the target db.
+    """
+    url = copy.copy(engine.url)
+    url.database = database
+    return sqlalchemy.create_engine(url, poolclass=sqlalchemy.pool.NullPool)
+
+
+def _terminate_backends(connection, dbname):
+    """ Kill off all other connections to the named database
+    """
+    connection.execute(text("""
+        select pg_terminate_backend(pid)
+        from pg_stat_activity
+        where datname=:dbname
+        and pid <> pg_backend_pid()"""), dbname=dbname)
+
+
+def _pg_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def _pg_setting(config):
+    """ SET clause for a 'name=value' entry of pg_db_role_setting.setconfig
+    """
+    name, value = config.split('=', 1)
+    if name in _PG_LIST_SETTINGS:
+        items = [i.strip() for i in value.split(',')]
+        items = [i[1:-1].replace('""', '"') if i.startswith('"') else i for i in items]
+        return 'SET {} = {}'.format(name, ', '.join(_pg_literal(i) for i in items))
+    return 'SET {} = {}'.format(name, _pg_literal(value))
+
+
+def _create_database_like(connection, dbname, staging):
+    """ Create the staging database with the owner and connection limit of the live one
+    """
+    owner, limit = connection.execute(text("""
+        select quote_ident(pg_get_userbyid(datdba)), datconnlimit
+        from pg_database where datname=:dbname"""), dbname=dbname).first()
+    connection.execute('CREATE DATABASE "{}" OWNER {} CONNECTION LIMIT {}'.format(staging, owner, limit))
+
+
+def _copy_database_settings(connection, dbname, staging):
+    """ Copy the ALTER DATABASE settings (including those for a role in the database),
+        GRANTs and COMMENT of the live database to the staging one. These belong to the
+        database rather than its contents, so aren't in a pg_dump of it.
+    """
+    settings = connection.execute(text("""
+        select quote_ident(r.rolname), s.setconfig
+        from pg_db_role_setting s
+        join pg_database d on d.oid = s.setdatabase
+        left join pg_roles r on r.oid = s.setrole
+        where d.datname=:dbname"""), dbname=dbname).fetchall()
+    for role, config in settings:
+        for entry in config:
+            if role:
+                connection.execute('ALTER ROLE {} IN DATABASE "{}" {}'.format(role, staging, _pg_setting(entry)))
+            else:
+                connection.execute('ALTER DATABASE "{}" {}'.format(staging, _pg_setting(entry)))
+
+    owner, has_acl, comment = connection.execute(text("""
+        select quote_ident(pg_get_userbyid(datdba)), datacl is not null,
+               quote_literal(shobj_description(oid, 'pg_database'))
+        from pg_database where datname=:dbname"""), dbname=dbname).first()
+    if has_acl:
+        # Replace the default privileges with those of the live database
+        connection.execute('REVOKE ALL ON DATABASE "{}" FROM PUBLIC'.format(staging))
+        connection.execute('REVOKE ALL ON DATABASE "{}" FROM {}'.format(staging, owner))
+        grants = connection.execute(text("""
+            select case when a.grantee = 0 then 'PUBLIC' else quote_ident(pg_get_userbyid(a.grantee)) end,
+                   a.privilege_type, a.is_grantable
+            from pg_database d, aclexplode(d.datacl) a
+            where d.datname=:dbname"""), dbname=dbname).fetchall()
+        for grantee, privilege, grantable in grants:
+            connection.execute('GRANT {} ON DATABASE "{}" TO {}{}'.format(
+                privilege, staging, grantee, ' WITH GRANT OPTION' if grantable else ''))
+    if comment is not None:
+        connection.execute('COMMENT ON DATABASE "{}" IS {}'.format(staging, comment))
+
+
+def _rename_databases(connection, dbname, staging, retired, timeout=SWAP_TIMEOUT):
+    """ Rename the live database out of the way and the staging one into its place, in
+        one transaction. pg_terminate_backend doesn't wait for the backends to exit, so
+        the rename is retried for up to `timeout` seconds while they are still going.
+    """
+    deadline = time.time() + timeout
+    while True:
+        txn = connection.begin()
+        try:
+            _terminate_backends(connection, dbname)
+            connection.execute('ALTER DATABASE "{}" RENAME TO "{}"'.format(dbname, retired))
+            connection.execute('ALTER DATABASE "{}" RENAME TO "{}"'.format(staging, dbname))
+            txn.commit()
+            return
+        except sqlalchemy.exc.DBAPIError as e:
+            txn.rollback()
+            if getattr(e.orig, 'pgcode', None) != _PG_OBJECT_IN_USE or time.time() >= deadline:
+                raise
+            log.info("Waiting for connections to {} to close".format(dbname))
+            time.sleep(0.1)
+
+
+def swap_load_postgresql(engine, dump_file, progress=None):
+    """ Load a postgresql dump file into a staging database alongside the live one, then
+        swap them over by renaming both in a single transaction. The live database is
+        only unavailable for the duration of the rename. New connections are refused
+        while it is renamed, which needs PostgreSQL 9.5 or later.
+
+        The staging database is created with the live one's owner and connection limit,
+        and given its ALTER DATABASE settings, GRANTs and COMMENT before the swap. Other
+        database level properties, eg. a non-default encoding, locale or tablespace, are
+        the server's defaults.
+    """
+    dbname = engine.url.database
+    staging = '{}_restore'.format(dbname)
+    retired = '{}_retired'.format(dbname)
+    admin = _admin_engine(engine)
+    try:
+        with contextlib.closing(admin.connect()) as connection:
+            autocommit = connection.execution_options(isolation_level='AUTOCOMMIT')
+            autocommit.execute('DROP DATABASE IF EXISTS "{}"'.format(staging))
+            autocommit.execute('DROP DATABASE IF EXISTS "{}"'.format(retired))
+            _create_database_like(autocommit, dbname, staging)
+
+        log.info("Loading Postgresql database from {} into staging database {}".format(dump_file, staging))
+        try:
+            if _psql_load_file(engine, staging, dump_file, progress=progress,
+                               args=['--set=ON_ERROR_STOP=1', '--single-transaction']):
+                raise BackupError("Failed loading {} into {}".format(dump_file, staging))
+            # After the load, so settings such as default_transaction_read_only don't affect it
+            with contextlib.closing(admin.connect()) as connection:
+                _copy_database_settings(connection.execution_options(isolation_level='AUTOCOMMIT'),
+                                        dbname, staging)
+        except Exception:
+            with contextlib.closing(admin.connect()) as connection:
+                connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+                    'DROP DATABASE IF EXISTS "{}"'.format(staging))
+            raise
+
+        log.warn("Swapping restored Postgresql database {} into place as {}".format(staging, dbname))
+        with contextlib.closing(admin.connect()) as connection:
+            autocommit = connection.execution_options(isolation_level='AUTOCOMMIT')
+            # Stop pools reconnecting to the live database as their connections are terminated
+            autocommit.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS false'.format(dbname))
+            try:
+                _rename_databases(connection, dbname, staging, retired)
+            except Exception:
+                autocommit.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS true'.format(dbname))
+                autocommit.execute('DROP DATABASE IF EXISTS "{}"'.format(staging))
+                raise
+            autocommit.execute('ALTER DATABASE "{}" ALLOW_CONNECTIONS true'.format(dbname))
+            autocommit.execute('DROP DATABASE "{}"'.format(retired))
+    finally:
+        admin.dispose()
+    # Pooled connections were terminated along with the old database
+    engine.dispose()
 
 
 def drop_postgresql(engine, metadata):
@@ -180,13 +903,9 @@ def drop_postgresql(engine, metadata):
     # XXX this requires superuser! make it a script or something...
     # First kill off all open connections or the db drop will hang. 
     with contextlib.closing(engine.connect()) as connection:
-	txn = connection.begin()
-	connection.execute(text("""
-		select pg_terminate_backend(procpid)
-	        from pg_stat_activity 
-		where datname='{engine.url.database}' 
-		and procpid <> pg_backend_pid()""".format(**locals())))
-	txn.commit()
+        txn = connection.begin()
+        _terminate_backends(connection, engine.url.database)
+        txn.commit()
     drop_generic(engine, metadata)
    
 
@@ -195,8 +914,25 @@ ENGINE_MAP = {
         'postgresql': (dump_postgresql, load_postgresql, drop_postgresql)
 }
 
-def dump_database(session_or_engine, backup_dir):
+# Non-destructive restore: load into a side database and swap it in
+SWAP_LOAD_MAP = {
+        'sqlite': swap_load_sqlite,
+        'postgresql': swap_load_postgresql,
+}
+
+# Restore of selected tables from a dump of just those tables
+TABLE_LOAD_MAP = {
+        'sqlite': load_tables_sqlite,
+        'postgresql': load_tables_postgresql,
+}
+
+def dump_database(session_or_engine, backup_dir, progress=None, tables=None, jobs=None):
     """ Backs up a database from the session to a backup dir
+
+        :param progress:  optional :class:`BackupProgress` to report progress to and cancel with
+        :param tables:    names of the tables to dump, rather than the whole database. They
+                          are dumped from a single consistent snapshot.
+        :param jobs:      most tables to dump at once, defaults to the CPU count
     """ 
     if hasattr(session_or_engine, 'get_bind'):
         engine = session_or_engine.get_bind()
@@ -204,11 +940,17 @@ def dump_database(session_or_engine, backup_dir):
         engine = session_or_engine
 
     dump, _, _ = ENGINE_MAP[engine.name]
-    return dump(engine, backup_dir)
+    if tables:
+        return dump(engine, backup_dir, progress=progress, tables=tables, jobs=jobs)
+    return dump(engine, backup_dir, progress=progress)
 
 
-def load_database(session_or_engine, metadata, dump_file):
+def load_database(session_or_engine, metadata, dump_file, progress=None):
     """ Restores a database from the session and dump file
+
+        :param progress:  optional :class:`BackupProgress` to report progress to and cancel with.
+                          Cancelling stops the load part way through, after the existing data
+                          has already been dropped.
     """ 
     if hasattr(session_or_engine, 'get_bind'):
         engine = session_or_engine.get_bind()
@@ -217,4 +959,30 @@ def load_database(session_or_engine, metadata, dump_file):
     _, load, drop = ENGINE_MAP[engine.name]
     log.warn("Destroying all existing data in database at {}".format(engine.url.database))
     drop(engine, metadata)
-    load(engine, dump_file)
+    load(engine, dump_file, progress=progress)
+
+
+def swap_load_database(session_or_engine, dump_file, progress=None):
+    """ Restores a database from the dump file without dropping the live database
+        first. The dump is loaded and checked in a staging database while the live one
+        stays in service, then swapped into place. Cancelling through `progress` removes
+        the staging database and leaves the live one untouched.
+    """
+    if hasattr(session_or_engine, 'get_bind'):
+        engine = session_or_engine.get_bind()
+    else:
+        engine = session_or_engine
+    swap_load = SWAP_LOAD_MAP[engine.name]
+    swap_load(engine, dump_file, progress=progress)
+
+
+def load_tables_database(session_or_engine, dump_file, tables, progress=None):
+    """ Restores the given tables from a dump of selected tables, leaving the rest
+        of the database alone. The tables are replaced in a single transaction.
+    """
+    if hasattr(session_or_engine, 'get_bind'):
+        engine = session_or_engine.get_bind()
+    else:
+        engine = session_or_engine
+    load_tables = TABLE_LOAD_MAP[engine.name]
+    load_tables(engine, dump_file, tables, progress=progress)
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`benchmark` --- Benchmark harness
+==================================================================================
+
+.. module:: benchmark
+   :synopsis: Reproducible benchmarks for the pp.db hot paths.
+
+The :mod:`pp.db.benchmark` module times the generic CRUD helpers, session
+creation, :func:`pp.db.dbsetup.init` start up and backup dump/load throughput
+against a file backed SQLite database holding a generated schema.
+
+Results are written as JSON so runs can be compared::
+
+    python -m pp.db.benchmark --sizes 1000,10000 --output before.json
+    ... make changes ...
+    python -m pp.db.benchmark --sizes 1000,10000 --output after.json --compare before.json
+
+Other modules add benchmarks with the :func:`benchmark` decorator.
+"""
+import argparse
+import collections
+import datetime
+import fnmatch
+import gc
+import itertools
+import json
+import logging
+import math
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+import sqlalchemy
+from sqlalchemy import Column
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import select
+from path import path
+
+from pp.db import dbsetup, session, utils, backup
+
+
+def get_log():
+    return logging.getLogger('pp.db.benchmark')
+
+
+# Registered benchmarks: name -> function(ctx) returning a stats dict
+BENCHMARKS = collections.OrderedDict()
+
+# The generated schema has its own declarative base, so its tables stay out of
+# the Base.metadata that dbsetup.create() builds.
+SchemaBase = declarative_base()
+
+# Declarative classes for the generated schema, keyed by (columns, table index)
+_schema_classes = {}
+
+
+def benchmark(name):
+    """ Register a benchmark function under the given name. The function is called
+        with a :class:`BenchmarkContext` and returns the stats dict from :func:`measure`.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat=5, number=100):
+    """ Time a function call.
+
+    :param func:    function to time, called with no arguments
+    :param repeat:  number of timing runs
+    :param number:  calls per timing run
+
+    :returns: dict of per-call timings in seconds plus 'ops_per_sec' for the best run.
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        for _ in range(number):
+            func()
+        times.append((timeit.default_timer() - start) / number)
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        'repeat': repeat,
+        'number': number,
+        'min': times[0],
+        'max': times[-1],
+        'mean': mean,
+        'median': times[len(times) // 2],
+        'stdev': math.sqrt(sum((t - mean) ** 2 for t in times) / len(times)),
+        'ops_per_sec': 1.0 / times[0] if times[0] else 0.0,
+    }
+
+
+class BenchmarkSchema(object):
+    """ A generated pp.db module of `tables` tables, each with an integer primary key,
+        an indexed 'name' column and `columns` string columns. The tables are declared
+        on :data:`SchemaBase`, see :meth:`create`.
+    """
+    def __init__(self, tables=1, columns=4):
+        self.columns = columns
+        self.bases = [self._table_class(i) for i in range(tables)]
+
+    def _table_class(self, index):
+        key = (self.columns, index)
+        if key not in _schema_classes:
+            attrs = {
+                '__tablename__': 'pp_db_bench_c{}_t{}'.format(*key),
+                'id': Column(sqlalchemy.types.Integer, primary_key=True, autoincrement=False),
+                'name': Column(sqlalchemy.types.String(36), nullable=False, index=True),
+            }
+            for i in range(self.columns):
+                attrs['col{}'.format(i)] = Column(sqlalchemy.types.String(64))
+            _schema_classes[key] = type(str('BenchC{}T{}'.format(*key)), (SchemaBase,), attrs)
+        return _schema_classes[key]
+
+    @property
+    def record(self):
+        """ The declarative class the CRUD benchmarks run against
+        """
+        return self.bases[0]
+
+    def row(self, i):
+        """ Column values for the i'th generated row
+        """
+        values = dict(('col{}'.format(c), 'value {} {}'.format(i, c)) for c in range(self.columns))
+        values.update(id=i, name='name-{}'.format(i % 100))
+        return values
+
+    def populate(self, engine, rows, chunk=1000):
+        for base in self.bases:
+            table = base.__table__
+            for start in range(0, rows, chunk):
+                engine.execute(table.insert(), [self.row(i) for i in range(start, min(start + chunk, rows))])
+
+    def init(self):
+        return (self.bases, [], [])
+
+    def create(self, engine):
+        """ Create the generated tables
+        """
+        SchemaBase.metadata.create_all(engine, tables=[b.__table__ for b in self.bases])
+
+
+class BenchmarkContext(object):
+    """ State shared by the benchmarks for one data size: a file backed SQLite database
+        initialised through dbsetup and populated with `size` rows per table.
+    """
+    def __init__(self, workdir, size, schema, repeat=5, number=100, init_kwargs=None):
+        self.workdir = path(workdir)
+        self.size = size
+        self.schema = schema
+        self.repeat = repeat
+        self.number = number
+        self.init_kwargs = dict(init_kwargs or {}, use_transaction=False)
+        self.dbfile = self.workdir / 'bench-{}.db'.format(size)
+        self.uri = 'sqlite:///' + self.dbfile
+
+    def setup(self):
+        self.dbfile.remove_p()
+        self.init()
+        self.schema.create(dbsetup.engine)
+        self.schema.populate(dbsetup.engine, self.size)
+
+    def init(self):
+        dbsetup.init(self.uri, **self.init_kwargs)
+
+    def teardown(self):
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+
+    def keys(self):
+        """ Endless cycle of primary keys that exist in the populated table
+        """
+        return itertools.cycle(range(self.size))
+
+
+@benchmark('crud.get')
+def bench_get(ctx):
+    get = utils.generic_get(ctx.schema.record)
+    keys = ctx.keys()
+    return measure(lambda: get(next(keys)), ctx.repeat, ctx.number)
+
+
+@benchmark('crud.has')
+def bench_has(ctx):
+    has = utils.generic_has(ctx.schema.record)
+    keys = ctx.keys()
+    return measure(lambda: has(next(keys)), ctx.repeat, ctx.number)
+
+
+@benchmark('crud.find')
+def bench_find(ctx):
+    find = utils.generic_find(ctx.schema.record)
+    names = itertools.cycle(range(100))
+    return measure(lambda: find(name='name-{}'.format(next(names))), ctx.repeat, ctx.number)
+
+
+@benchmark('crud.add')
+def bench_add(ctx):
+    add = utils.generic_add(ctx.schema.record)
+    keys = itertools.count(ctx.size)
+    return measure(lambda: add(**ctx.schema.row(next(keys))), ctx.repeat, ctx.number)
+
+
+@benchmark('crud.update')
+def bench_update(ctx):
+    update = utils.generic_update(ctx.schema.record)
+    keys = ctx.keys()
+    return measure(lambda: update(next(keys), col0='updated'), ctx.repeat, ctx.number)
+
+
+@benchmark('crud.remove')
+def bench_remove(ctx):
+    remove = utils.generic_remove(ctx.schema.record)
+    # Rows to remove use negative keys, clear of the populated and added rows
+    count = ctx.repeat * ctx.number
+    dbsetup.engine.execute(ctx.schema.record.__table__.insert(),
+                           [ctx.schema.row(-i) for i in range(1, count + 1)])
+    keys = itertools.count(-1, -1)
+    return measure(lambda: remove(next(keys)), ctx.repeat, ctx.number)
+
+
+@benchmark('session.create')
+def bench_session(ctx):
+    def create():
+        session()
+        dbsetup.Session.remove()
+    return measure(create, ctx.repeat, ctx.number)
+
+
+@benchmark('dbsetup.init')
+def bench_init(ctx):
+    try:
+        return measure(ctx.init, ctx.repeat, max(1, ctx.number // 10))
+    finally:
+        ctx.init()
+
+
+def approx_row_bytes(rows, sample=200, depth=4):
+    """ Rough memory held per row of a query result: the row object plus everything it
+        references within `depth` steps that no other sampled row also references
+        (so classes, mappers and sessions aren't counted).
+    """
+    rows = rows[:sample]
+    if not rows:
+        return 0
+    owners = collections.defaultdict(int)
+    sizes = {}
+    for row in rows:
+        seen = set()
+        level = [row]
+        for _ in range(depth):
+            following = []
+            for item in level:
+                if id(item) in seen or isinstance(item, (type, type(sys))):
+                    continue
+                seen.add(id(item))
+                sizes[id(item)] = sys.getsizeof(item)
+                following.extend(gc.get_referents(item))
+            level = following
+        for i in seen:
+            owners[i] += 1
+    return sum(sizes[i] for i, count in owners.items() if count == 1) // len(rows)
+
+
+def approx_column_bytes(columns):
+    """ Memory held per row by a dict of column arrays: the arrays, plus the values
+        of those holding references (lists and NumPy object arrays) rather than the
+        values themselves.
+    """
+    arrays = list(columns.values())
+    count = len(arrays[0]) if arrays else 0
+    if not count:
+        return 0
+    total = 0
+    seen = set()
+    for array in arrays:
+        total += sys.getsizeof(array)
+        dtype = getattr(array, 'dtype', None)
+        if dtype is None or dtype.kind == 'O':
+            for value in array:
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+    return total // count
+
+
+def _measure_scan(ctx, func):
+    """ Time reading every row of the benchmark table, adding rows/sec and memory per row
+    """
+    def run():
+        func()
+        dbsetup.Session.remove()
+    stats = measure(run, ctx.repeat, 1)
+    # Earlier benchmarks such as crud.add leave more than ctx.size rows
+    table = ctx.schema.record.__table__
+    scanned = dbsetup.engine.execute(select([sqlalchemy.func.count()]).select_from(table)).scalar()
+    stats['rows'] = scanned
+    stats['rows_per_second'] = scanned / stats['min'] if stats['min'] else 0.0
+    rows = func()
+    if isinstance(rows, dict):
+        stats['bytes_per_row'] = approx_column_bytes(rows)
+    else:
+        stats['bytes_per_row'] = approx_row_bytes(rows)
+    dbsetup.Session.remove()
+    return stats
+
+
+# The columns a typical report reads from each row
+_SCAN_COLUMNS = ['id', 'name', 'col0']
+
+
+@benchmark('scan.find')
+def bench_scan_find(ctx):
+    return _measure_scan(ctx, utils.generic_find(ctx.schema.record))
+
+
+@benchmark('scan.project.tuple')
+def bench_scan_tuple(ctx):
+    return _measure_scan(ctx, utils.generic_project(ctx.schema.record, _SCAN_COLUMNS))
+
+
+@benchmark('scan.project.record')
+def bench_scan_record(ctx):
+    return _measure_scan(ctx, utils.generic_project(ctx.schema.record, _SCAN_COLUMNS, 'record'))
+
+
+@benchmark('scan.project.columns')
+def bench_scan_columns(ctx):
+    return _measure_scan(ctx, utils.generic_project(ctx.schema.record, _SCAN_COLUMNS, 'columns'))
+
+
+@benchmark('scan.project.batches')
+def bench_scan_batches(ctx):
+    project_batches = utils.generic_project_batches(ctx.schema.record, _SCAN_COLUMNS, 10000)
+
+    def scan():
+        # Only one batch is held at a time, report the size of the last
+        for batch in project_batches():
+            pass
+        return batch
+    return _measure_scan(ctx, scan)
+
+
+def _measure_backup(ctx, func):
+    """ Time a dump or load, adding throughput figures from its :class:`BackupProgress`
+    """
+    progresses = []
+
+    def run():
+        progress = backup.BackupProgress()
+        func(progress)
+        progresses.append(progress)
+    stats = measure(run, ctx.repeat, 1)
+    best = max(progresses, key=lambda p: p.throughput)
+    stats.update(bytes=best.bytes,
+                 rows=best.rows,
+                 bytes_per_second=best.throughput,
+                 rows_per_second=best.rows / best.elapsed if best.elapsed else 0.0)
+    return stats
+
+
+@benchmark('backup.dump')
+def bench_dump(ctx):
+    api = backup.DatabaseBackupAPI(dbsetup.engine, SchemaBase.metadata, ctx.workdir / 'backups')
+    return _measure_backup(ctx, lambda progress: api.dump(progress=progress))
+
+
+@benchmark('backup.load')
+def bench_load(ctx):
+    api = backup.DatabaseBackupAPI(dbsetup.engine, SchemaBase.metadata, ctx.workdir / 'backups')
+    dump_file = api.dump()
+    dbsetup.Session.remove()
+    return _measure_backup(ctx, lambda progress: api.load(api.get_id(dump_file), swap=True,
+                                                         progress=progress))
+
+
+def run(sizes=(1000,), select=None, repeat=5, number=100, tables=1, columns=4,
+        workdir=None, init_kwargs=None):
+    """ Run the registered benchmarks at each data size.
+
+    :param sizes:       rows per generated table
+    :param select:      fnmatch patterns of benchmark names to run, default all
+    :param repeat:      timing runs per benchmark
+    :param number:      calls per timing run
+    :param tables:      number of tables in the generated schema
+    :param columns:     string columns per generated table
+    :param workdir:     directory for the database files, default a temporary dir
+    :param init_kwargs: extra keyword arguments for :func:`pp.db.dbsetup.init`
+
+    :returns: dict with 'meta' describing the run and 'results' of
+              '<name>[<size>]' -> stats dict.
+
+    The benchmarks set up dbsetup's engine and session for each size. Those the
+    caller had set up are put back afterwards.
+
+    """
+    names = [n for n in BENCHMARKS if not select or any(fnmatch.fnmatch(n, s) for s in select)]
+    schema = BenchmarkSchema(tables, columns)
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp()
+    results = collections.OrderedDict()
+    saved = (dbsetup.engine, dbsetup.Session, dbsetup.Base.metadata.bind)
+    try:
+        for size in sizes:
+            ctx = BenchmarkContext(workdir, size, schema, repeat, number, init_kwargs)
+            ctx.setup()
+            try:
+                for name in names:
+                    get_log().info("Running {}[{}]".format(name, size))
+                    results['{}[{}]'.format(name, size)] = BENCHMARKS[name](ctx)
+            finally:
+                ctx.teardown()
+    finally:
+        dbsetup.engine, dbsetup.Session, dbsetup.Base.metadata.bind = saved
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'sizes': list(sizes),
+            'repeat': repeat,
+            'number': number,
+            'tables': tables,
+            'columns': columns,
+            'init_kwargs': init_kwargs or {},
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline):
+    """ Compare two benchmark runs.
+
+    :returns: list of (name, baseline min, min, speedup) for benchmarks in both runs,
+              where speedup > 1 means `results` is faster.
+
+    """
+    rows = []
+    for name, stats in results['results'].items():
+        if name in baseline['results']:
+            before = baseline['results'][name]['min']
+            rows.append((name, before, stats['min'], before / stats['min'] if stats['min'] else 0.0))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="comma separated rows per table (default: %(default)s)")
+    parser.add_argument('--select', action='append',
+                        help="only run benchmarks matching this pattern, eg. 'crud.*'")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--tables', type=int, default=1)
+    parser.add_argument('--columns', type=int, default=4)
+    parser.add_argument('--profile', default=None,
+                        help="engine tuning profile from pp.db.profiles, eg. 'sqlite'")
+    parser.add_argument('--output', help="write JSON results to this file, default stdout")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--list', action='store_true', help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        sys.stdout.write('\n'.join(BENCHMARKS) + '\n')
+        return 0
+
+    results = run(sizes=[int(i) for i in args.sizes.split(',')], select=args.select,
+                  repeat=args.repeat, number=args.number, tables=args.tables,
+                  columns=args.columns, init_kwargs={'profile': args.profile})
+    output = json.dumps(results, indent=2)
+    if args.output:
+        path(args.output).write_text(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+    if args.compare:
+        baseline = json.loads(path(args.compare).text())
+        for name, before, after, speedup in compare(results, baseline):
+            sys.stderr.write('{:<30} {:>12.6f} {:>12.6f} {:>8.2f}x\n'.format(name, before, after, speedup))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARN)
+    sys.exit(main())
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`cdc` --- Change data capture
+==================================================================================
+
+.. module:: cdc
+   :synopsis: Transactional outbox of insert/update/delete events.
+
+The :mod:`pp.db.cdc` module records changes made through a session to the
+tables registered with :func:`pp.db.dbsetup.setup` in an outbox table. Events
+are written in the same transaction as the change, as it commits, so they are
+committed or rolled back along with it. Consumers read them incrementally by cursor
+instead of polling the tables with `generic_find`::
+
+    from pp.db import dbsetup, cdc
+
+    dbsetup.setup(modules=[cdc, mymodels])
+    dbsetup.init(uri)
+    dbsetup.create()
+    cdc.capture(['user', 'account'])
+
+    cursor = load_my_cursor()
+    for events in cdc.iter_changes(cursor, tables=['user']):
+        update_search_index(events)
+        cursor = events[-1].id
+        save_my_cursor(cursor)
+
+Event ids follow the order the flushes wrote the rows in. When an object is
+deleted and another added with the same primary key in one flush, SQLAlchemy
+updates the row in place; this is recorded as a delete of the old row followed
+by an insert of the new one. Changes rolled back to a savepoint are dropped.
+
+The events of a transaction are kept in the session until it commits, and only
+then given their ids and `created` time. With concurrent writers a transaction
+can still finish committing after one holding a later id has been read, so
+consumers of a busy multi-writer database should stay a second or two behind
+the head of the outbox, see the `settle` argument of :func:`read_changes`.
+
+Only changes flushed from ORM objects are captured. Bulk `Query.update()` and
+`Query.delete()` and SQL run with `session.execute()`, eg.
+`session.execute(table.update())`, bypass the capture; the bulk query methods
+log a warning when they touch a captured table.
+"""
+import collections
+import datetime
+import json
+import logging
+
+import sqlalchemy
+from sqlalchemy import Column, event
+from sqlalchemy.orm import Mapper, attributes, object_session
+from sqlalchemy.sql import select, and_
+
+from pp.db import Base, dbsetup, session
+
+
+def get_log():
+    return logging.getLogger('pp.db.cdc')
+
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class Outbox(Base):
+    """
+    One captured change to a row of a registered table.
+    """
+    __tablename__ = 'pp_db_outbox'
+
+    id = Column(sqlalchemy.types.Integer, primary_key=True)
+    table_name = Column(sqlalchemy.types.String(200), nullable=False, index=True)
+    operation = Column(sqlalchemy.types.String(6), nullable=False)
+    # JSON list of the primary key values
+    pk = Column(sqlalchemy.types.Text, nullable=False)
+    # JSON object of the row's column values, the old values for a delete
+    data = Column(sqlalchemy.types.Text, nullable=False)
+    # JSON list of the changed columns for an update
+    changed = Column(sqlalchemy.types.Text)
+    created = Column(sqlalchemy.types.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+# A change as returned to consumers, with the JSON fields decoded
+ChangeEvent = collections.namedtuple(
+    'ChangeEvent', ['id', 'table_name', 'operation', 'pk', 'data', 'changed', 'created'])
+
+# Names of the tables changes are captured for
+_captured = set()
+
+# Session classes the flush listeners have been added to
+_listening = []
+
+# Key of the changes recorded during a flush in Session.info
+_INFO_KEY = 'pp.db.cdc'
+
+# Key of the transaction's flushed changes waiting for the commit in Session.info
+_PENDING_KEY = 'pp.db.cdc.pending'
+
+
+def init():
+    """Called to do the initial metadata set up.
+
+    Returns a list of the tables, mappers and declarative base classes this
+    module implements.
+
+    """
+    declarative_bases = [Outbox]
+    tables = []
+    mappers = []
+    return (declarative_bases, tables, mappers)
+
+
+def capture(names=None, Session=None):
+    """Start capturing changes to the named tables.
+
+    :param names: table names known to dbsetup (its `bases` and `tables`),
+    by default all of them.
+
+    :param Session: session class to listen to, by default the one set up
+    by `dbsetup.init`. Can be called again for other session classes, eg.
+    those of a :class:`pp.db.tenants.EngineRegistry`.
+
+    """
+    if names is None:
+        names = set(dbsetup.bases) | set(dbsetup.tables)
+        names.discard(Outbox.__tablename__)
+    for name in names:
+        if name not in dbsetup.bases and name not in dbsetup.tables:
+            raise ValueError("Table %r is not known to dbsetup, is its module set up?" % name)
+    _captured.update(names)
+
+    Session = Session or dbsetup.Session
+    assert Session, "Please setup the database before capturing changes"
+    if not _listening:
+        event.listen(Mapper, 'after_insert', _after_insert)
+        event.listen(Mapper, 'after_update', _after_update)
+        event.listen(Mapper, 'after_delete', _after_delete)
+    if Session not in _listening:
+        event.listen(Session, 'before_flush', _before_flush)
+        event.listen(Session, 'after_flush', _after_flush)
+        event.listen(Session, 'after_transaction_create', _after_transaction_create)
+        event.listen(Session, 'after_transaction_end', _after_transaction_end)
+        event.listen(Session, 'before_commit', _before_commit)
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_bulk_update', _after_bulk_update)
+        event.listen(Session, 'after_bulk_delete', _after_bulk_delete)
+        _listening.append(Session)
+    get_log().info("capture: recording changes to %s" % sorted(_captured))
+
+
+def stop(names=None):
+    """
+    Stop capturing changes to the named tables, by default all of them.
+    """
+    if names is None:
+        _captured.clear()
+    else:
+        _captured.difference_update(names)
+
+
+def _json(value):
+    return json.dumps(value, default=str, sort_keys=True)
+
+
+def _event(obj, operation):
+    """
+    Outbox row values for a flushed change to obj, or None if it isn't captured.
+    """
+    name = getattr(type(obj), '__tablename__', None)
+    if name not in _captured:
+        return None
+    state = sqlalchemy.inspect(obj)
+    mapper = state.mapper
+    # Only the loaded values, so nothing is fetched from a row that's just been deleted
+    data = dict((p.key, state.dict[p.key]) for p in mapper.column_attrs if p.key in state.dict)
+    pk = [state.dict.get(mapper.get_property_by_column(c).key) for c in mapper.primary_key]
+    changed = None
+    if operation == UPDATE:
+        changed = sorted(p.key for p in mapper.column_attrs
+                         if attributes.get_history(obj, p.key).has_changes())
+        if not changed:
+            return None
+        changed = _json(changed)
+    return {'table_name': name, 'operation': operation, 'pk': _json(pk), 'data': _json(data),
+            'changed': changed}
+
+
+def _before_flush(s, flush_context, instances):
+    """
+    Start recording the flush's changes, noting the objects it deletes.
+    """
+    s.info.pop(_INFO_KEY, None)
+    if not _captured:
+        return
+    deleted = dict((sqlalchemy.inspect(obj).key, obj) for obj in s.deleted)
+    s.info[_INFO_KEY] = {'rows': [], 'deleted': deleted}
+
+
+def _record(target, operation):
+    """
+    Add the change to target to its session's recorded changes, if any.
+    """
+    s = object_session(target)
+    changes = s.info.get(_INFO_KEY) if s is not None else None
+    if changes is None:
+        return
+    if operation == INSERT:
+        # A deleted object replaced by a new one with the same key is flushed as an
+        # update of the new one, without a delete of the old.
+        key = sqlalchemy.inspect(target).mapper.identity_key_from_instance(target)
+        replaced = changes['deleted'].pop(key, None)
+        if replaced is not None:
+            _record(replaced, DELETE)
+    elif operation == DELETE:
+        changes['deleted'].pop(sqlalchemy.inspect(target).key, None)
+    row = _event(target, operation)
+    if row is not None:
+        changes['rows'].append(row)
+
+
+def _after_insert(mapper, connection, target):
+    _record(target, INSERT)
+
+
+def _after_update(mapper, connection, target):
+    _record(target, UPDATE)
+
+
+def _after_delete(mapper, connection, target):
+    _record(target, DELETE)
+
+
+def _pending(s):
+    return s.info.setdefault(_PENDING_KEY, {'rows': [], 'savepoints': {}})
+
+
+def _after_flush(s, flush_context):
+    """
+    Keep the flushed changes, in the order they were flushed, until the
+    transaction commits.
+    """
+    changes = s.info.pop(_INFO_KEY, None)
+    if changes and changes['rows']:
+        _pending(s)['rows'].extend(changes['rows'])
+
+
+def _after_transaction_create(s, transaction):
+    """
+    Note how many changes were flushed before a savepoint, to drop those
+    flushed after it if it is rolled back.
+    """
+    if transaction.nested:
+        pending = _pending(s)
+        pending['savepoints'][transaction] = len(pending['rows'])
+
+
+def _after_commit(s):
+    """
+    Keep the changes of a savepoint which has been released.
+    """
+    pending = s.info.get(_PENDING_KEY)
+    if pending is not None and s.transaction.nested:
+        pending['savepoints'].pop(s.transaction, None)
+
+
+def _after_transaction_end(s, transaction):
+    """
+    Forget the changes of a transaction which has ended, and those of a
+    savepoint which ended without being released.
+    """
+    pending = s.info.get(_PENDING_KEY)
+    if pending is None:
+        return
+    if transaction.nested:
+        mark = pending['savepoints'].pop(transaction, None)
+        if mark is not None:
+            del pending['rows'][mark:]
+    elif transaction._parent is None:
+        s.info.pop(_PENDING_KEY, None)
+
+
+def _before_commit(s):
+    """
+    Write outbox rows for the transaction's changes as it commits, so their ids
+    and created time are handed out as late as possible.
+    """
+    if s.transaction.nested:
+        return
+    if s.new or s.dirty or s.deleted:
+        s.flush()
+    pending = s.info.pop(_PENDING_KEY, None)
+    if pending and pending['rows']:
+        created = datetime.datetime.utcnow()
+        for row in pending['rows']:
+            row['created'] = created
+        s.execute(Outbox.__table__.insert(), pending['rows'])
+
+
+def _warn_bulk(query, operation):
+    """
+    Warn that a bulk update or delete of a captured table isn't recorded.
+    """
+    names = set(getattr(d['entity'], '__tablename__', None) for d in query.column_descriptions)
+    if names & _captured:
+        get_log().warning("Bulk %s of %s is not captured" % (operation, ', '.join(sorted(names & _captured))))
+
+
+def _after_bulk_update(update_context):
+    _warn_bulk(update_context.query, UPDATE)
+
+
+def _after_bulk_delete(delete_context):
+    _warn_bulk(delete_context.query, DELETE)
+
+
+def _decode(row):
+    return ChangeEvent(row.id, row.table_name, row.operation, json.loads(row.pk), json.loads(row.data),
+                       json.loads(row.changed) if row.changed else None, row.created)
+
+
+def read_changes(cursor=0, limit=1000, tables=None, settle=None):
+    """Read a batch of changes after the given cursor, oldest first.
+
+    :param cursor: the id of the last event already processed, 0 to start
+    at the beginning of the outbox.
+
+    :param limit: most events to return.
+
+    :param tables: only return changes to these table names.
+
+    :param settle: only return events at least this many seconds old, giving
+    concurrent transactions time to commit.
+
+    :returns: a list of ChangeEvent. Pass the id of the last one as the next
+    cursor.
+
+    """
+    outbox = Outbox.__table__
+    where = [outbox.c.id > cursor]
+    if tables is not None:
+        where.append(outbox.c.table_name.in_(list(tables)))
+    if settle:
+        where.append(outbox.c.created <= datetime.datetime.utcnow() - datetime.timedelta(seconds=settle))
+    query = select([outbox]).where(and_(*where)).order_by(outbox.c.id).limit(limit)
+    return [_decode(row) for row in session().execute(query)]
+
+
+def iter_changes(cursor=0, batch_size=1000, tables=None, settle=None):
+    """
+    Yield batches of changes after the given cursor until the outbox is
+    exhausted. See :func:`read_changes`.
+    """
+    while True:
+        events = read_changes(cursor, batch_size, tables, settle)
+        if not events:
+            return
+        yield events
+        cursor = events[-1].id
+
+
+def purge(cursor):
+    """Delete events up to and including the given cursor, once every
+    consumer has processed them.
+
+    :returns: the number of events deleted.
+
+    """
+    outbox = Outbox.__table__
+    return session().execute(outbox.delete().where(outbox.c.id <= cursor)).rowcount
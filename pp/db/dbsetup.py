@@ -5,13 +5,17 @@ Common Database initialisation Tools
 Edward Easton, Oisin Mulvihill
 
 """
+import os
 import logging
 import importlib
 
 import sqlalchemy
+from sqlalchemy import event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from pp.db import profiles
+
 
 def get_log():
     return logging.getLogger("pp.db.setup")
@@ -21,6 +25,17 @@ def get_log():
 engine = None
 Session = None
 
+# Per tenant engines and sessions set up by the init_registry() function:
+engines = None
+
+# Process the engines and sessions were set up in, see check_fork()
+_pid = os.getpid()
+
+# Connections and sessions inherited from the parent after a fork. These are
+# kept referenced so garbage collection never closes, rolls back or otherwise
+# talks over sockets the parent process is still using.
+_inherited = []
+
 Base = declarative_base()
 
 # Table lookup for our baseclasses (as they are not showing up in metadata.tables)
@@ -107,7 +122,7 @@ def setup(modules=[], mappers=[]):
 
 
 def init(uri, pool_size=5, pool_max_overflow=10, pool_timeout=30, pool_recycle=-1,
-         use_transaction=True):
+         use_transaction=True, profile=None):
     """Called to do the initial metadata set up for all the database modules
        passed in via the :meth:`setup` method.
 
@@ -121,28 +136,120 @@ def init(uri, pool_size=5, pool_max_overflow=10, pool_timeout=30, pool_recycle=-
     :param pool_timeout:        Connection pool timeout in seconds
     :type pool_recycle:         Integer
     :param pool_recycle:        Connection pool recycle time in seconds
+    :type profile:              String
+    :param profile:             Engine tuning profile name from :mod:`pp.db.profiles`,
+                                or 'auto' to pick one for the database dialect
 
     """
     get_log().info("init: starting project wide setup...")
 
     global engine, Session, Base
 
-    engine = sqlalchemy.create_engine(
-        uri,
+    engine = make_engine(uri, pool_size, pool_max_overflow, pool_timeout, pool_recycle, profile)
+    Session = make_session(engine, use_transaction)
+    Base.metadata.bind = engine
+    _set_pid()
+    init_modules()
+
+
+def make_engine(uri, pool_size=5, pool_max_overflow=10, pool_timeout=30, pool_recycle=-1,
+                profile=None):
+    """Create an engine with the pool settings used by :meth:`init`.
+
+    :param profile: engine tuning profile, see :func:`pp.db.profiles.get_profile`.
+
+    :returns: a SQLAlchemy engine, using a QueuePool unless the profile says otherwise.
+
+    """
+    profile = profiles.get_profile(profile, uri)
+    options = profile.engine_options(sqlalchemy.engine.url.make_url(uri), dict(
         poolclass=sqlalchemy.pool.QueuePool,
         pool_size=pool_size,
         max_overflow=pool_max_overflow,
+        pool_timeout=pool_timeout,
         pool_recycle=pool_recycle,
         echo=False,
         echo_pool=False,
-    )
+    ))
+    return make_fork_safe(profile.configure(sqlalchemy.create_engine(uri, **options)))
+
+
+def make_fork_safe(engine):
+    """Stop pooled connections being shared with forked child processes.
+
+    Each connection is tagged with the process that opened it. When a child
+    checks out a connection it inherited from its parent, the connection is
+    dropped without being closed and a fresh one opened in its place, so
+    pools are rebuilt lazily in the child.
+
+    :returns: the engine.
+
+    """
+    if getattr(engine, '_pp_fork_safe', False):
+        return engine
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get('pid', pid) != pid:
+            _inherited.append(dbapi_connection)
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid %s, attempting to check out in pid %s" %
+                (connection_record.info['pid'], pid))
+
+    engine._pp_fork_safe = True
+    return engine
+
+
+def _set_pid():
+    global _pid
+    _pid = os.getpid()
+
+
+def check_fork():
+    """Called by :func:`pp.db.session` and :func:`pp.db.engine` to notice when we
+    are running in a process forked after the database was set up. The sessions
+    inherited from the parent are set aside, so the child starts with new ones.
+    Inherited pool connections are replaced on checkout, see :meth:`make_fork_safe`.
+    """
+    if _pid != os.getpid():
+        after_fork()
+
+
+def after_fork():
+    """Reset the session and registry state inherited from a parent process. This
+    is called automatically by :meth:`check_fork`, but can also be hooked into a
+    server's post fork hook, eg. gunicorn's `post_fork`.
+    """
+    get_log().info("after_fork: resetting sessions inherited from pid %s in pid %s" % (_pid, os.getpid()))
+    if Session is not None and hasattr(Session, 'registry') and Session.registry.has():
+        _inherited.append(Session.registry())
+        Session.registry.clear()
+    # The engines hold the parent's pooled connections, so keep them referenced
+    # in case the child replaces them, eg. by calling init() again.
+    if engine is not None:
+        _inherited.append(engine)
+    if engines is not None:
+        _inherited.append(engines)
+        engines.after_fork(_inherited)
+    _set_pid()
+
+
+def make_session(bind, use_transaction=True):
+    """Create a scoped session class bound to the given engine.
+
+    :param use_transaction: join sessions to the zope transaction manager.
+
+    """
     if use_transaction:
         from zope.sqlalchemy import ZopeTransactionExtension
-        Session = scoped_session(sessionmaker(bind=engine, extension=ZopeTransactionExtension()))
-    else:
-        Session = scoped_session(sessionmaker(bind=engine))
-    Base.metadata.bind = engine
-    init_modules()
+        return scoped_session(sessionmaker(bind=bind, extension=ZopeTransactionExtension()))
+    return scoped_session(sessionmaker(bind=bind))
 
 
 def init_with_session(bind, session):
@@ -151,23 +258,65 @@ def init_with_session(bind, session):
     get_log().info("init: starting project wide setup given bind and session: %s %s" % \
         (bind, session))
     Session = session
-    engine = bind
+    engine = make_fork_safe(bind)
     Base.metadata.bind = bind
+    _set_pid()
     init_modules()
 
 
-def init_from_config(settings, prefix='sqlalchemy.', use_transaction=True):
+def init_from_config(settings, prefix='sqlalchemy.', use_transaction=True, profile=None):
     """ As above but use a settings dict, eg from a Pyramid config
     """
     global Session, engine, Base
-    engine = sqlalchemy.engine_from_config(settings, prefix)
-    if use_transaction:
-        from zope.sqlalchemy import ZopeTransactionExtension
-        Session = scoped_session(sessionmaker(bind=engine, extension=ZopeTransactionExtension()))
-    else:
-        Session = scoped_session(sessionmaker(bind=engine))
+    profile = profiles.get_profile(profile, settings[prefix + 'url'])
+    options = profile.engine_options(sqlalchemy.engine.url.make_url(settings[prefix + 'url']), {})
+    engine = make_fork_safe(profile.configure(sqlalchemy.engine_from_config(settings, prefix, **options)))
+    Session = make_session(engine, use_transaction)
     Base.metadata.bind = engine
+    _set_pid()
+    init_modules()
+
+
+def init_registry(resolver=None, max_engines=100, max_connections=None, pool_size=5,
+                  pool_max_overflow=10, pool_timeout=30, pool_recycle=-1, use_transaction=True,
+                  profile=None):
+    """Set up a :class:`pp.db.tenants.EngineRegistry` so one process can serve many
+       databases. Code run inside :func:`pp.db.tenants.tenant` gets that tenant's
+       session and engine from :func:`pp.db.session` and :func:`pp.db.engine`.
+
+       This can be used alongside :meth:`init`, which still provides the default
+       session and engine outside of any tenant.
+
+    :param resolver:   callable returning the database URI for a tenant name which
+                       hasn't been registered with :meth:`EngineRegistry.register`.
+
+    See :class:`pp.db.tenants.EngineRegistry` for the other parameters.
+
+    :returns: the registry, also available as `pp.db.dbsetup.engines`.
+
+    """
+    from pp.db.tenants import EngineRegistry
+    global engines
+    get_log().info("init_registry: starting multi-tenant setup...")
+    engines = EngineRegistry(
+        resolver=resolver,
+        max_engines=max_engines,
+        max_connections=max_connections,
+        pool_size=pool_size,
+        pool_max_overflow=pool_max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        use_transaction=use_transaction,
+        profile=profile,
+    )
     init_modules()
+    return engines
+
+
+def registered_modules():
+    """ The db modules passed in via the :meth:`setup` method, in order.
+    """
+    return list(__modules)
 
 
 def init_modules():
@@ -196,11 +345,19 @@ def create():
        passed in via the :meth:`setup` method.
     """
     get_log().info("create: starting project wide create...")
+    migrating = [mod for mod in __modules if hasattr(mod, 'migrations')]
+    if migrating:
+        existing = set(sqlalchemy.inspect(Base.metadata.bind).get_table_names())
     Base.metadata.create_all()
     for mod in __modules:
         # Call module create hook if it's there
         if hasattr(mod, 'create'):
             mod.create()
+    if migrating:
+        # Tables created just now are at the latest version. Modules with tables
+        # which were already there keep their migrations pending.
+        from pp.db import migrations
+        migrations.stamp([mod for mod in migrating if migrations.created(mod, existing)])
     get_log().info("create: done.")
 
 
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`migrations` --- Versioned schema migrations and online backfills
+==================================================================================
+
+.. module:: migrations
+   :synopsis: Upgrade the tables of the modules registered with dbsetup.
+
+The :mod:`pp.db.migrations` module applies schema changes to the tables of the
+modules registered with :func:`pp.db.dbsetup.setup`. A db module declares its
+migrations with a `migrations()` function alongside its `init()`, numbered
+from 1 in the order they are to be run::
+
+    from pp.db.migrations import Migration, Backfill
+
+    def migrations():
+        return [
+            Migration(1, "Add email", "ALTER TABLE user ADD COLUMN email VARCHAR(200)"),
+            Backfill(2, "Default email", User, {'email': User.name + '@example.com'},
+                     where=User.email == None, batch_size=5000, pause=0.1),
+        ]
+
+:func:`migrate` runs the migrations which haven't been applied yet, recording
+each one in the `pp_db_migrations` table. When :func:`pp.db.dbsetup.create`
+creates all of a module's tables they already have the latest schema, so it
+marks the module's migrations as applied. Modules whose tables were already
+there are left for :func:`migrate`. Use :func:`stamp` to mark migrations
+applied by other means.
+
+A :class:`Backfill` updates a table in primary key order, a batch of rows per
+transaction, so locks are only held for one batch at a time. The last key
+updated is checkpointed with each batch: a backfill which is stopped, by
+failure or the `time_limit` of :func:`migrate`, carries on from there the
+next time :func:`migrate` is run.
+"""
+import datetime
+import json
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy import Column
+from sqlalchemy.sql import select, and_
+
+from pp.db import Base, dbsetup
+
+
+def get_log():
+    return logging.getLogger('pp.db.migrations')
+
+
+RUNNING = 'running'
+DONE = 'done'
+
+
+class MigrationError(Exception):
+    """
+    Raised for badly declared migrations.
+    """
+
+
+class SchemaVersion(Base):
+    """
+    A migration applied, or a backfill in progress.
+    """
+    __tablename__ = 'pp_db_migrations'
+
+    module = Column(sqlalchemy.types.String(200), primary_key=True)
+    version = Column(sqlalchemy.types.Integer, primary_key=True, autoincrement=False)
+    description = Column(sqlalchemy.types.String(200))
+    state = Column(sqlalchemy.types.String(10), nullable=False)
+    # JSON encoded primary key of the last row a backfill has updated
+    checkpoint = Column(sqlalchemy.types.Text)
+    rows = Column(sqlalchemy.types.Integer, nullable=False, default=0)
+    started = Column(sqlalchemy.types.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished = Column(sqlalchemy.types.DateTime)
+
+
+def init():
+    """Called to do the initial metadata set up.
+
+    Returns a list of the tables, mappers and declarative base classes this
+    module implements.
+
+    """
+    declarative_bases = [SchemaVersion]
+    tables = []
+    mappers = []
+    return (declarative_bases, tables, mappers)
+
+
+class Migration(object):
+    """
+    A schema change, run in a single transaction with its version record.
+    """
+    def __init__(self, version, description, upgrade):
+        """
+        :param version:     number of the migration within its module
+        :param description: what the migration does, recorded when it is applied
+        :param upgrade:     SQL statement, list of them, or a callable taking a
+                            connection with a transaction begun
+        """
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+    def __repr__(self):
+        return '<%s %d %r>' % (self.__class__.__name__, self.version, self.description)
+
+    def run(self, engine, module, progress=None, time_limit=None):
+        """Apply the migration.
+
+        :returns: True once it has been applied.
+
+        """
+        versions = SchemaVersion.__table__
+        with engine.begin() as connection:
+            if callable(self.upgrade):
+                self.upgrade(connection)
+            else:
+                statements = [self.upgrade] if isinstance(self.upgrade, basestring) else self.upgrade
+                for statement in statements:
+                    connection.execute(statement)
+            now = datetime.datetime.utcnow()
+            connection.execute(versions.insert(), module=module, version=self.version,
+                               description=self.description, state=DONE, rows=0,
+                               started=now, finished=now)
+        return True
+
+
+class Backfill(Migration):
+    """ A data change made in batches of rows, in primary key order. Each batch is
+        committed with a checkpoint of the last primary key it reached, so the
+        backfill can be stopped and resumed, and locks are held for one batch at a time.
+    """
+    def __init__(self, version, description, table, values, where=None, batch_size=1000, pause=0.0):
+        """
+        :param table:      declarative class or Table to update. It must have a
+                           single column primary key.
+        :param values:     dict of column name to value or SQL expression to set, or
+                           a callable taking (connection, low, high) which updates the
+                           rows with primary keys after low (None for the first
+                           batch) up to and including high, and returns the row count
+        :param where:      only update rows matching this SQL expression
+        :param batch_size: rows to update per transaction
+        :param pause:      seconds to sleep between batches, to leave the database
+                           time for other work
+        """
+        super(Backfill, self).__init__(version, description, None)
+        self.table = getattr(table, '__table__', table)
+        pk = list(self.table.primary_key.columns)
+        if len(pk) != 1:
+            raise MigrationError("Backfill of %s needs a single column primary key" % self.table.name)
+        self.pk = pk[0]
+        self.values = values
+        self.where = where
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def _range(self, low, high):
+        where = [self.pk <= high]
+        if low is not None:
+            where.append(self.pk > low)
+        if self.where is not None:
+            where.append(self.where)
+        return and_(*where)
+
+    def batch(self, connection, low):
+        """Update the next batch of rows after the primary key low.
+
+        :returns: (rows updated, primary key of the last row in the batch),
+                  or (0, None) when there are no rows left.
+
+        """
+        query = select([self.pk]).order_by(self.pk).limit(self.batch_size)
+        if low is not None:
+            query = query.where(self.pk > low)
+        keys = [row[0] for row in connection.execute(query)]
+        if not keys:
+            return 0, None
+        high = keys[-1]
+        if callable(self.values):
+            rows = self.values(connection, low, high)
+        else:
+            rows = connection.execute(
+                self.table.update().where(self._range(low, high)).values(self.values)).rowcount
+        return rows, high
+
+    def run(self, engine, module, progress=None, time_limit=None):
+        versions = SchemaVersion.__table__
+        key = and_(versions.c.module == module, versions.c.version == self.version)
+        with engine.begin() as connection:
+            row = connection.execute(select([versions]).where(key)).first()
+            if row is None:
+                connection.execute(versions.insert(), module=module, version=self.version,
+                                   description=self.description, state=RUNNING, rows=0,
+                                   started=datetime.datetime.utcnow())
+                low, rows = None, 0
+            else:
+                low = json.loads(row.checkpoint) if row.checkpoint else None
+                rows = row.rows
+                get_log().info("Resuming %s %r after %r" % (module, self, low))
+
+        while True:
+            if time_limit is not None and time.time() >= time_limit:
+                get_log().info("Stopping %s %r at %r for now" % (module, self, low))
+                return False
+            with engine.begin() as connection:
+                count, high = self.batch(connection, low)
+                if high is None:
+                    connection.execute(versions.update().where(key), state=DONE,
+                                       finished=datetime.datetime.utcnow())
+                    return True
+                rows += count
+                low = high
+                connection.execute(versions.update().where(key), checkpoint=json.dumps(low), rows=rows)
+            if progress:
+                progress(module, self, rows, low)
+            if self.pause:
+                time.sleep(self.pause)
+
+
+def declared(modules=None):
+    """Return the migrations declared by db modules, in the order they run.
+
+    :param modules: db modules, by default those registered with dbsetup.
+
+    :returns: a list of (module name, Migration).
+
+    """
+    if modules is None:
+        modules = dbsetup.registered_modules()
+    found = []
+    seen = set()
+    for mod in modules:
+        if not hasattr(mod, 'migrations'):
+            continue
+        # Migrations are recorded under the module's name
+        name = getattr(mod, '__name__', None) or type(mod).__name__
+        if name in seen:
+            continue
+        seen.add(name)
+        migrations = sorted(mod.migrations(), key=lambda m: m.version)
+        versions = [m.version for m in migrations]
+        if versions != range(1, len(versions) + 1):
+            raise MigrationError("Migrations of %s should be numbered 1 to %d, not %s"
+                                 % (name, len(versions), versions))
+        found.extend((name, m) for m in migrations)
+    return found
+
+
+def created(mod, existing):
+    """
+    Return True if the module has tables and none of them are in `existing`,
+    the names of the tables in the database before they were created.
+    """
+    bases, tables, _ = mod.init()
+    names = set(getattr(t, '__tablename__', None) or t.name for t in list(bases) + list(tables))
+    return bool(names) and not names & set(existing)
+
+
+def _engine(engine):
+    engine = engine or dbsetup.engine
+    assert engine, "Please setup the database before running migrations"
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    return engine
+
+
+def _applied(engine):
+    versions = SchemaVersion.__table__
+    query = select([versions.c.module, versions.c.version]).where(versions.c.state == DONE)
+    return set(tuple(row) for row in engine.execute(query))
+
+
+def pending(modules=None, engine=None):
+    """
+    Return the (module name, Migration) not yet applied, including backfills
+    which were stopped part way through.
+    """
+    applied = _applied(_engine(engine))
+    return [(name, m) for name, m in declared(modules) if (name, m.version) not in applied]
+
+
+def migrate(modules=None, engine=None, time_limit=None, progress=None):
+    """Apply the pending migrations, in order.
+
+    :param modules: db modules, by default those registered with dbsetup.
+
+    :param engine: defaults to the one set up by `dbsetup.init`.
+
+    :param time_limit: seconds after which to stop, between backfill batches.
+    The remaining migrations are left pending.
+
+    :param progress: called with (module name, migration, rows, checkpoint)
+    after each backfill batch.
+
+    :returns: the (module name, Migration) applied.
+
+    """
+    engine = _engine(engine)
+    if time_limit is not None:
+        time_limit = time.time() + time_limit
+    done = []
+    for name, migration in pending(modules, engine):
+        get_log().info("migrate: %s %r" % (name, migration))
+        if not migration.run(engine, name, progress=progress, time_limit=time_limit):
+            break
+        done.append((name, migration))
+    get_log().info("migrate: %d applied, %d pending" % (len(done), len(pending(modules, engine))))
+    return done
+
+
+def stamp(modules=None, engine=None):
+    """Mark the declared migrations as applied without running them, eg. when
+    the tables have just been created with the latest schema.
+
+    :returns: the (module name, Migration) marked.
+
+    """
+    engine = _engine(engine)
+    versions = SchemaVersion.__table__
+    marked = pending(modules, engine)
+    with engine.begin() as connection:
+        now = datetime.datetime.utcnow()
+        for name, migration in marked:
+            connection.execute(versions.delete().where(
+                and_(versions.c.module == name, versions.c.version == migration.version)))
+            connection.execute(versions.insert(), module=name, version=migration.version,
+                               description=migration.description, state=DONE, rows=0,
+                               started=now, finished=now)
+    return marked
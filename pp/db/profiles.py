@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`profiles` --- Engine tuning profiles
+==================================================================================
+
+.. module:: profiles
+   :synopsis: Named, dialect specific engine and connection settings.
+
+The :mod:`pp.db.profiles` module holds the tuning profiles which can be
+selected by name with the `profile` argument of :func:`pp.db.dbsetup.init`,
+:func:`pp.db.dbsetup.init_from_config` and :func:`pp.db.dbsetup.init_registry`.
+
+A profile adjusts the keyword arguments passed to `create_engine` (pool class,
+connect_args) and runs statements on every new DBAPI connection (eg. SQLite
+PRAGMAs). The 'auto' profile picks the profile named after the URI's dialect,
+falling back to 'default' which leaves the engine as it always was.
+
+Compare profiles with the benchmark harness::
+
+    python -m pp.db.benchmark --profile default --output default.json
+    python -m pp.db.benchmark --profile sqlite --compare default.json
+"""
+import logging
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+
+
+def get_log():
+    return logging.getLogger('pp.db.profiles')
+
+
+# Pool arguments only understood by QueuePool
+_QUEUE_POOL_ARGS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class EngineProfile(object):
+    """
+    Named engine tuning for a dialect.
+    """
+    def __init__(self, name, dialect=None, engine_kwargs=None, connect_args=None, statements=()):
+        """
+        :param dialect:       dialect name this profile applies to, or None for any
+        :param engine_kwargs: extra `create_engine` keyword arguments
+        :param connect_args:  extra DBAPI `connect()` keyword arguments
+        :param statements:    SQL run on each new DBAPI connection
+        """
+        self.name = name
+        self.dialect = dialect
+        self.engine_kwargs = engine_kwargs or {}
+        self.connect_args = connect_args or {}
+        self.statements = list(statements)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+    def engine_options(self, url, options):
+        """Return the `create_engine` keyword arguments to use for the given url.
+
+        :param options: the keyword arguments :func:`pp.db.dbsetup.make_engine`
+                        would use without a profile.
+
+        """
+        options = dict(options, **self.engine_kwargs)
+        if self.connect_args:
+            options['connect_args'] = dict(options.get('connect_args', {}), **self.connect_args)
+        return options
+
+    def configure(self, engine):
+        """Hook the profile's connection statements into a new engine.
+
+        :returns: the engine.
+
+        """
+        if self.statements:
+            statements = self.statements
+
+            @event.listens_for(engine, 'connect')
+            def connect(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                try:
+                    for statement in statements:
+                        cursor.execute(statement)
+                finally:
+                    cursor.close()
+        return engine
+
+
+class SQLiteProfile(EngineProfile):
+    """
+    SQLite tuned with PRAGMAs set on every connection. WAL journaling lets
+    readers carry on while a writer commits, and the busy timeout makes
+    writers wait for each other rather than fail with 'database is locked'.
+    """
+    def __init__(self, name, journal_mode='WAL', synchronous='NORMAL', mmap_size=256 * 1024 * 1024,
+                 cache_size=-64 * 1024, busy_timeout=5000, **kwargs):
+        """
+        :param journal_mode:  PRAGMA journal_mode, eg. WAL, DELETE
+        :param synchronous:   PRAGMA synchronous, eg. OFF, NORMAL, FULL
+        :param mmap_size:     bytes of the database file to memory map
+        :param cache_size:    page cache size; negative values are in KiB
+        :param busy_timeout:  milliseconds to wait on a locked database
+        """
+        statements = [
+            'PRAGMA busy_timeout = %d' % busy_timeout,
+            'PRAGMA journal_mode = %s' % journal_mode,
+            'PRAGMA synchronous = %s' % synchronous,
+            'PRAGMA mmap_size = %d' % mmap_size,
+            'PRAGMA cache_size = %d' % cache_size,
+        ] + list(kwargs.pop('statements', []))
+        super(SQLiteProfile, self).__init__(name, 'sqlite', statements=statements, **kwargs)
+
+    def engine_options(self, url, options):
+        options = super(SQLiteProfile, self).engine_options(url, options)
+        if url.database in (None, '', ':memory:'):
+            # Each in memory database lives and dies with its connection, so keep
+            # one per thread as SQLAlchemy does by default.
+            options['poolclass'] = sqlalchemy.pool.SingletonThreadPool
+            for arg in _QUEUE_POOL_ARGS:
+                options.pop(arg, None)
+        else:
+            # The pool hands a connection to one thread at a time, so it is safe
+            # for it to move between threads.
+            options['connect_args'] = dict(options.get('connect_args', {}), check_same_thread=False)
+        return options
+
+
+class PostgreSQLProfile(EngineProfile):
+    """
+    PostgreSQL with server side timeouts, passed as startup options so they
+    cost no extra round trip per connection. Each timeout is left at the
+    server's setting when None.
+    """
+    def __init__(self, name, statement_timeout=None, lock_timeout=None,
+                 idle_in_transaction_timeout=None, **kwargs):
+        """
+        :param statement_timeout:           milliseconds before a statement is cancelled
+        :param lock_timeout:                milliseconds to wait for a lock, needs
+                                            PostgreSQL 9.3 or later
+        :param idle_in_transaction_timeout: milliseconds before an idle open transaction's
+                                            session is terminated, needs PostgreSQL 9.6
+                                            or later
+        """
+        settings = [
+            ('statement_timeout', statement_timeout),
+            ('lock_timeout', lock_timeout),
+            ('idle_in_transaction_session_timeout', idle_in_transaction_timeout),
+        ]
+        connect_args = dict(kwargs.pop('connect_args', {}))
+        options = ' '.join('-c %s=%d' % i for i in settings if i[1] is not None)
+        if options:
+            connect_args['options'] = options
+        super(PostgreSQLProfile, self).__init__(name, 'postgresql', connect_args=connect_args, **kwargs)
+
+
+PROFILES = {}
+
+
+def register_profile(profile):
+    """
+    Make a profile selectable by its name.
+    """
+    PROFILES[profile.name] = profile
+    return profile
+
+
+register_profile(EngineProfile('default'))
+register_profile(SQLiteProfile('sqlite'))
+register_profile(SQLiteProfile('sqlite-durable', synchronous='FULL'))
+register_profile(SQLiteProfile('sqlite-bulk', synchronous='OFF', cache_size=-512 * 1024))
+register_profile(PostgreSQLProfile('postgresql'))
+# Timeouts for request serving processes on PostgreSQL 9.6 or later. Long running
+# work such as migrations and backfills should use 'postgresql' instead.
+register_profile(PostgreSQLProfile('postgresql-timeouts', statement_timeout=30000, lock_timeout=10000,
+                                   idle_in_transaction_timeout=60000))
+
+
+def get_profile(profile, uri):
+    """Look up a profile for the given database URI.
+
+    :param profile: profile name, 'auto' to pick one by dialect, an
+                    :class:`EngineProfile` or None for 'default'.
+
+    :returns: an :class:`EngineProfile`.
+
+    """
+    dialect = make_url(uri).drivername.split('+')[0]
+    if isinstance(profile, EngineProfile):
+        found = profile
+    else:
+        if profile is None:
+            profile = 'default'
+        elif profile == 'auto':
+            profile = dialect if dialect in PROFILES else 'default'
+        if profile not in PROFILES:
+            raise ValueError("Unknown engine profile %r, expected one of %s" % (profile, sorted(PROFILES)))
+        found = PROFILES[profile]
+    if found.dialect and found.dialect != dialect:
+        raise ValueError("Engine profile %r is for %s databases, not %s" % (found.name, found.dialect, uri))
+    return found
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`resilience` --- Retries, circuit breaking and deadlines
+==================================================================================
+
+.. module:: resilience
+   :synopsis: Keep database outages from stalling the whole service.
+
+The :mod:`pp.db.resilience` module wraps database calls, such as the methods
+made by the :mod:`pp.db.utils` factories, so that:
+
+ * transient errors (disconnects, lock and serialization failures) are
+   retried with jittered exponential backoff;
+ * each call has a deadline, which also bounds every statement it runs;
+ * a circuit breaker fails calls fast while the database keeps failing,
+   rather than letting them queue up for pool connections.
+
+::
+
+    from pp.db import dbsetup, resilience, utils
+
+    dbsetup.init(uri)
+    resilience.install()
+    guard = resilience.Resilience(timeout=2.0)
+    get_user = guard(utils.generic_get(User))
+
+Each retry rolls back the current session, or aborts the zope transaction
+when sessions are joined to one, so a wrapped call should be a whole unit
+of work. Calls which commit may run again if the connection drops
+after the commit was sent, so only wrap writes which are safe to repeat.
+"""
+import contextlib
+import functools
+import logging
+import random
+import threading
+import time
+
+import transaction
+from sqlalchemy import event, exc
+from sqlalchemy.sql import select
+
+from pp.db import dbsetup, session, tenants
+
+
+def get_log():
+    return logging.getLogger('pp.db.resilience')
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a call runs past its deadline.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the database while the circuit breaker is open.
+    """
+
+
+# SQLSTATEs worth retrying: serialization failure, deadlock, admin shutdown
+# and connection failures.
+TRANSIENT_SQLSTATES = frozenset(['40001', '40P01', '57P01', '08000', '08003', '08006'])
+
+# Error message fragments worth retrying, for drivers without SQLSTATEs.
+TRANSIENT_MESSAGES = (
+    'database is locked',
+    'database table is locked',
+    'server closed the connection',
+    'could not connect to server',
+    'connection reset',
+)
+
+
+def is_transient(error):
+    """
+    Return True if the error is one a retry may succeed after.
+    """
+    if isinstance(error, exc.DisconnectionError):
+        return True
+    if not isinstance(error, exc.DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    if getattr(error.orig, 'pgcode', None) in TRANSIENT_SQLSTATES:
+        return True
+    message = str(error.orig).lower()
+    return any(m in message for m in TRANSIENT_MESSAGES)
+
+
+# Per thread deadline (a time.time() value) of the call in progress
+_local = threading.local()
+
+
+def current_deadline():
+    """
+    Return the deadline of the wrapped call running in this thread, or None.
+    """
+    return getattr(_local, 'deadline', None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Set a deadline for the block. Statements run in it are interrupted at
+    the deadline on engines set up with :func:`install`. Nested deadlines can
+    only shorten the outer one.
+
+    """
+    outer = current_deadline()
+    _local.deadline = time.time() + seconds
+    if outer is not None:
+        _local.deadline = min(outer, _local.deadline)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = outer
+
+
+class CircuitBreaker(object):
+    """ Opens after `failure_threshold` consecutive failed calls. While open, calls
+        fail straight away with :class:`CircuitOpenError`. After `reset_timeout` seconds
+        a single trial call is let through: if it succeeds the circuit closes again,
+        otherwise it stays open for another `reset_timeout`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError unless a call may go ahead.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError("Database circuit open after %d failures" % self.failures)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    get_log().error("Opening database circuit after %d failures" % self.failures)
+                self.opened_at = time.time()
+            self._trial = False
+
+
+class Resilience(object):
+    """ Retry policy, circuit breaker and deadline shared by all the calls it wraps.
+    """
+    def __init__(self, attempts=3, backoff=0.05, max_backoff=1.0, timeout=None,
+                 breaker=None, failure_threshold=5, reset_timeout=30):
+        """
+        :param attempts:    most times to try a call
+        :param backoff:     seconds to wait before the first retry, doubling each retry
+        :param max_backoff: most seconds to wait between tries
+        :param timeout:     default deadline in seconds for each call, None for none
+        :param breaker:     :class:`CircuitBreaker` to share, or one is made from
+                            `failure_threshold` and `reset_timeout`
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker(failure_threshold, reset_timeout)
+
+    def __call__(self, func, timeout=None):
+        """
+        Return a wrapped version of func, eg. a generic_get method, optionally
+        with its own timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        # Partials and other callables may not have a __name__ to copy
+        assigned = [a for a in functools.WRAPPER_ASSIGNMENTS if hasattr(func, a)]
+
+        @functools.wraps(func, assigned)
+        def wrapper(*args, **kwargs):
+            return self.call_with_timeout(timeout, func, *args, **kwargs)
+        return wrapper
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func with retries, the circuit breaker and the default timeout.
+        """
+        return self.call_with_timeout(self.timeout, func, *args, **kwargs)
+
+    def call_with_timeout(self, timeout, func, *args, **kwargs):
+        self.breaker.before_call()
+        if timeout is None:
+            return self._attempts(func, args, kwargs)
+        with deadline(timeout):
+            return self._attempts(func, args, kwargs)
+
+    def _sleep_time(self, attempt):
+        # "Full jitter": a random wait up to the exponential backoff
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def _attempts(self, func, args, kwargs):
+        attempt = 0
+        while True:
+            if _expired():
+                self.breaker.failure()
+                raise DeadlineExceeded("Database call ran past its deadline")
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                expired = _expired()
+                if not is_transient(e) and not expired:
+                    # The database answered, it's the call that's wrong
+                    self.breaker.success()
+                    raise
+                _rollback()
+                attempt += 1
+                if expired or attempt >= self.attempts:
+                    self.breaker.failure()
+                    if expired:
+                        raise DeadlineExceeded("Database call ran past its deadline: %s" % e)
+                    raise
+                wait = self._sleep_time(attempt - 1)
+                until = current_deadline()
+                if until is not None:
+                    wait = min(wait, max(0, until - time.time()))
+                get_log().warn("Retrying database call in %.3fs after: %s" % (wait, e))
+                time.sleep(wait)
+            else:
+                self.breaker.success()
+                return result
+
+
+def _expired():
+    deadline = current_deadline()
+    return deadline is not None and time.time() >= deadline
+
+
+def _use_transaction():
+    """
+    Return True if the current session is joined to zope transactions.
+    """
+    if tenants.current_tenant() is not None and dbsetup.engines is not None:
+        return dbsetup.engines.use_transaction
+    factory = getattr(dbsetup.Session, 'session_factory', None)
+    extensions = getattr(factory, 'kw', {}).get('extension') or []
+    if not isinstance(extensions, (list, tuple)):
+        extensions = [extensions]
+    try:
+        from zope.sqlalchemy import ZopeTransactionExtension
+    except ImportError:
+        return False
+    return any(isinstance(e, ZopeTransactionExtension) for e in extensions)
+
+
+def _rollback():
+    """
+    Reset the current session after a failed attempt, ready for the next one.
+    Sessions joined to a zope transaction are reset by aborting it, as rolling
+    back the session alone leaves the transaction manager unable to commit.
+    """
+    try:
+        if _use_transaction():
+            transaction.abort()
+        else:
+            session().rollback()
+    except Exception:
+        get_log().exception("Rollback after failed database call failed")
+        dbsetup.Session.remove()
+
+
+def install(engine=None, pre_ping=True):
+    """Add connection checks and statement deadlines to an engine.
+
+    :param engine: defaults to the one set up by `dbsetup.init`.
+
+    :param pre_ping: test each connection with 'SELECT 1' as it is taken from
+    the pool, replacing stale ones before they fail a real query. This costs
+    a round trip per checkout.
+
+    Statements run inside a :func:`deadline` (or a call wrapped with a timeout)
+    are cut off at the deadline: with a progress handler on SQLite, and with
+    SET LOCAL statement_timeout on PostgreSQL. The PostgreSQL timeout is set
+    to the time left at the first statement of the deadline in each transaction,
+    so later statements can overrun the deadline by up to the time already
+    spent; the deadline is checked again before each retry.
+
+    :returns: the engine.
+
+    """
+    engine = engine or dbsetup.engine
+    assert engine, "Please setup the database before installing resilience"
+    if getattr(engine, '_pp_resilience', False):
+        return engine
+
+    if pre_ping:
+        @event.listens_for(engine, 'engine_connect')
+        def ping_connection(connection, branch):
+            if branch:
+                return
+            should_close = connection.should_close_with_result
+            connection.should_close_with_result = False
+            try:
+                connection.scalar(select([1]))
+            except exc.DBAPIError as e:
+                if not e.connection_invalidated:
+                    raise
+                # The pool replaces the invalidated connection on next use
+                connection.scalar(select([1]))
+            finally:
+                connection.should_close_with_result = should_close
+
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'before_cursor_execute')
+        def sqlite_deadline(connection, cursor, statement, parameters, context, executemany):
+            deadline = current_deadline()
+            dbapi_connection = connection.connection.connection
+            if deadline is None:
+                dbapi_connection.set_progress_handler(None, 0)
+            else:
+                dbapi_connection.set_progress_handler(lambda: int(time.time() >= deadline), 1000)
+
+    elif engine.dialect.name == 'postgresql':
+        @event.listens_for(engine, 'before_cursor_execute')
+        def postgresql_deadline(connection, cursor, statement, parameters, context, executemany):
+            # SET LOCAL lasts until the transaction ends, so it is only sent when the
+            # deadline changes. It gets a cursor of its own, as the statement's may be
+            # a named cursor for stream_results, which can only run the one query.
+            deadline = current_deadline()
+            info = connection.connection.info
+            if info.get('pp_deadline') == deadline:
+                return
+            set_cursor = connection.connection.cursor()
+            try:
+                if deadline is None:
+                    set_cursor.execute('SET LOCAL statement_timeout TO DEFAULT')
+                else:
+                    set_cursor.execute('SET LOCAL statement_timeout = %d' % max(1, (deadline - time.time()) * 1000))
+            finally:
+                set_cursor.close()
+            info['pp_deadline'] = deadline
+
+        @event.listens_for(engine, 'commit')
+        @event.listens_for(engine, 'rollback')
+        def postgresql_transaction_end(connection):
+            connection.connection.info.pop('pp_deadline', None)
+
+        @event.listens_for(engine.pool, 'checkin')
+        def postgresql_checkin(dbapi_connection, connection_record):
+            # The pool rolls back returned connections
+            connection_record.info.pop('pp_deadline', None)
+
+    engine._pp_resilience = True
+    return engine
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`tenants` --- Multi-tenant engine registry
+==================================================================================
+
+.. module:: tenants
+   :synopsis: Named engines and sessions for many databases in one process.
+
+The :mod:`pp.db.tenants` module keeps an engine and scoped session per tenant
+database. Engines are created on first use and the least recently used idle
+ones are disposed of once `max_engines` are open, which bounds the total
+number of pooled connections however many tenants a process serves.
+
+Requests are routed to a tenant with the :func:`tenant` context manager, after
+which :func:`pp.db.session` and :func:`pp.db.engine` return that tenant's
+session and engine::
+
+    from pp.db import dbsetup, tenants, session
+
+    dbsetup.setup(modules=[...])
+    dbsetup.init_registry(resolver=lambda name: 'postgresql://db/%s' % name,
+                          max_engines=50, max_connections=200)
+
+    with tenants.tenant('acme'):
+        session().query(...)
+
+The current tenant is held per thread.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+from pp.db import dbsetup
+
+
+def get_log():
+    return logging.getLogger('pp.db.tenants')
+
+
+class TenantError(Exception):
+    """
+    Raised when a tenant is not known to the registry.
+    """
+
+
+class RegistryFullError(TenantError):
+    """
+    Raised when a new tenant engine is needed but every open engine is busy.
+    """
+
+
+# Per thread stack of tenant names entered with tenant()
+_local = threading.local()
+
+# Most seconds a waiter for an idle engine goes without looking again. The pool
+# checkin event fires just before the connection is back in the pool, so the
+# engine may not look idle yet when the waiter is woken.
+_CHECKIN_POLL = 0.1
+
+
+def current_tenant():
+    """
+    Return the name of the tenant entered with :func:`tenant` in this thread, or
+    None when using the default database set up by :func:`pp.db.dbsetup.init`.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def tenant(name, remove_session=None):
+    """Route :func:`pp.db.session` and :func:`pp.db.engine` to the named tenant
+    for the duration of the block. Blocks can be nested.
+
+    :param remove_session: remove this thread's tenant session on exit, returning its
+                           connection to the pool so the engine can be evicted. By
+                           default this is only done when the registry's sessions aren't
+                           joined to zope transactions. Those are closed when the
+                           transaction commits or aborts, and removing them before then
+                           would lose the changes made in the block.
+
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(name)
+    try:
+        yield name
+    finally:
+        _local.stack.pop()
+        registry = dbsetup.engines
+        if remove_session is None:
+            remove_session = registry is not None and not registry.use_transaction
+        if remove_session and name not in _local.stack and registry is not None:
+            registry.remove_session(name)
+
+
+class _TenantEntry(object):
+    """
+    Engine and scoped session for one tenant.
+    """
+    def __init__(self, engine, Session):
+        self.engine = engine
+        self.Session = Session
+        self.last_used = time.time()
+
+    @property
+    def idle(self):
+        return self.engine.pool.checkedout() == 0
+
+
+class EngineRegistry(object):
+    """ Named engines and scoped sessions, created on demand and evicted least
+        recently used first.
+
+        The total number of pooled connections is at most
+        max_engines * (pool_size + pool_max_overflow). If `max_connections` is given
+        it is split evenly between the engines instead, with no overflow, and at
+        most `max_connections` engines are kept open.
+    """
+    def __init__(self, resolver=None, max_engines=100, max_connections=None, pool_size=5,
+                 pool_max_overflow=10, pool_timeout=30, pool_recycle=-1, use_transaction=True,
+                 profile=None):
+        """
+        :param resolver:         callable returning the URI for an unregistered tenant name
+        :param max_engines:      most tenant engines to keep open at once
+        :param max_connections:  most pooled connections across all tenants
+        :param pool_timeout:     seconds to wait for a pooled connection, and for an
+                                 engine to become idle when the registry is full
+        :param profile:          engine tuning profile, see :mod:`pp.db.profiles`
+        """
+        self.resolver = resolver
+        if max_connections:
+            # Every engine needs at least one connection
+            max_engines = min(max_engines, max_connections)
+            pool_size = max_connections // max_engines
+            pool_max_overflow = 0
+        self.max_engines = max_engines
+        self.pool_size = pool_size
+        self.pool_max_overflow = pool_max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.use_transaction = use_transaction
+        self.profile = profile
+        self._uris = {}
+        # name -> _TenantEntry. Looking up an open engine doesn't take the lock, so
+        # the least recently used is found from the entries' last_used.
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._checkin = threading.Condition(self._lock)
+        # Threads in _make_room waiting for an engine to go idle
+        self._waiting = 0
+
+    def register(self, name, uri):
+        """ Add or replace the database URI for a tenant
+        """
+        with self._lock:
+            self._uris[name] = uri
+            self._evict(name)
+
+    def unregister(self, name):
+        """ Forget a tenant, disposing of its engine
+        """
+        with self._lock:
+            self._uris.pop(name, None)
+            self._evict(name)
+
+    def uri(self, name):
+        if name in self._uris:
+            return self._uris[name]
+        if self.resolver is not None:
+            return self.resolver(name)
+        raise TenantError("Unknown tenant '%s'" % name)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def names(self):
+        """ Tenants with an open engine, least recently used first
+        """
+        with self._lock:
+            return self._lru()
+
+    def _lru(self):
+        return sorted(self._entries, key=lambda name: self._entries[name].last_used)
+
+    def _entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    uri = self.uri(name)
+                    self._make_room()
+                    get_log().info("Creating engine for tenant '%s'" % name)
+                    engine = dbsetup.make_engine(uri, self.pool_size, self.pool_max_overflow,
+                                                 self.pool_timeout, self.pool_recycle, self.profile)
+                    event.listen(engine.pool, 'checkin', self._on_checkin)
+                    entry = _TenantEntry(engine, dbsetup.make_session(engine, self.use_transaction))
+                    self._entries[name] = entry
+        entry.last_used = time.time()
+        return entry
+
+    def _make_room(self):
+        """ Evict least recently used idle engines until there is room for another,
+            waiting up to pool_timeout for one to go idle.
+        """
+        deadline = time.time() + self.pool_timeout
+        while len(self._entries) >= self.max_engines:
+            idle = [name for name in self._lru() if self._entries[name].idle]
+            if idle:
+                self._evict(idle[0])
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RegistryFullError("All %d tenant engines are in use" % len(self._entries))
+            self._waiting += 1
+            try:
+                self._checkin.wait(min(remaining, _CHECKIN_POLL))
+            finally:
+                self._waiting -= 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        # Only take the lock when a thread is waiting for an engine to go idle
+        if self._waiting:
+            with self._checkin:
+                self._checkin.notify_all()
+
+    def _evict(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            get_log().info("Disposing of engine for tenant '%s'" % name)
+            entry.Session.remove()
+            entry.engine.dispose()
+
+    def engine(self, name):
+        """ Return the named tenant's engine, creating it if needed
+        """
+        return self._entry(name).engine
+
+    def session(self, name):
+        """ Return this thread's session for the named tenant
+        """
+        return self._entry(name).Session()
+
+    def remove_session(self, name):
+        """ Close and discard this thread's session for the named tenant, if any
+        """
+        entry = self._entries.get(name)
+        if entry is not None:
+            entry.Session.remove()
+
+    def prune(self, max_idle):
+        """ Dispose of idle engines not used in the last `max_idle` seconds
+
+        :returns: names of the evicted tenants
+
+        """
+        cutoff = time.time() - max_idle
+        with self._lock:
+            names = [name for name, entry in self._entries.items()
+                     if entry.last_used < cutoff and entry.idle]
+            for name in names:
+                self._evict(name)
+        return names
+
+    def after_fork(self, inherited):
+        """ Reset state inherited from the parent process: new locks, in case another
+            thread held them at the fork, and the tenant engines and this thread's
+            sessions set aside in `inherited` rather than closed. Evicting an inherited
+            engine would close the parent's pooled connections, so the child creates
+            its own engines as tenants are used.
+        """
+        self._lock = threading.RLock()
+        self._checkin = threading.Condition(self._lock)
+        for entry in self._entries.values():
+            if entry.Session.registry.has():
+                inherited.append(entry.Session.registry())
+                entry.Session.registry.clear()
+            inherited.append(entry)
+        self._entries.clear()
+
+    def dispose(self):
+        """ Dispose of every tenant engine
+        """
+        with self._lock:
+            for name in list(self._entries):
+                self._evict(name)
@@ -1,11 +1,14 @@
 import tempfile
+import gzip
 import shutil
 import datetime
 import os
 import logging
 import operator
+import json
 
 import mock
+import sqlalchemy
 import transaction
 from path import path
 import pytest
@@ -100,14 +103,295 @@ def test_api_load():
              'foo.db.dump.20120103-1200.gz']
     try:
         for f in files:
-            (backup_dir / f).touch()
+            # Empty files would fail verification
+            _write_dump(backup_dir / f)
         session = mock.Mock()
         metadata = mock.Mock()
         api = backup.DatabaseBackupAPI(session, metadata, backup_dir)
         with mock.patch('pp.db.backup.load_database') as load:
             api.load("82f815406695e376a5b3ef687c8cdeb6")
-            load.assert_called_with(session.get_bind(), metadata, backup_dir / 'foo.db.dump.20120102-1200.gz')
+            load.assert_called_with(session.get_bind(), metadata, backup_dir / 'foo.db.dump.20120102-1200.gz',
+                                    progress=mock.ANY)
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+
+def _write_dump(dump_file, data="INSERT INTO test VALUES ('1', 'bar');\n" * 1000):
+    with gzip.open(dump_file, 'wb') as fh:
+        fh.write(data)
+    return dump_file
+
+
+def test_api_dump_records_checksum():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        api = backup.DatabaseBackupAPI(mock.Mock(), mock.Mock(), backup_dir)
+        dump_file = backup_dir / 'foo.db.dump.20120101-1200.gz'
+        with mock.patch('pp.db.backup.dump_database', side_effect=lambda e, d, progress: _write_dump(dump_file)):
+            assert api.dump({'note': 'nightly'}) == dump_file
+        [restore_point] = api.restore_points
+        md = restore_point['metadata']
+        assert md['note'] == 'nightly'
+        assert md['checksum'] == backup.checksum_file(dump_file)
+        assert md['checksum']['size'] == dump_file.size
+        assert api.verify() == {restore_point['id']: None}
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_api_verify_detects_corruption():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        api = backup.DatabaseBackupAPI(mock.Mock(), mock.Mock(), backup_dir)
+        good, truncated, tampered = [backup_dir / 'foo.db.dump.2012010{}-1200.gz'.format(i) for i in (1, 2, 3)]
+        for dump_file in (good, truncated, tampered):
+            with mock.patch('pp.db.backup.dump_database', return_value=_write_dump(dump_file)):
+                api.dump()
+        truncated.write_bytes(truncated.bytes()[:-20])
+        data = tampered.bytes()
+        tampered.write_bytes(data[:50] + chr(ord(data[50]) ^ 0xff) + data[51:])
+
+        result = api.verify(processes=2)
+        assert result[api.get_id(good)] is None
+        assert "size mismatch" in result[api.get_id(truncated)]
+        assert "checksum mismatch" in result[api.get_id(tampered)]
+
+        # Without a recorded checksum the gzip stream is still checked
+        api._meta_filename(truncated).remove()
+        result = api.verify([api.get_id(truncated)])
+        assert "unreadable gzip stream" in result[api.get_id(truncated)]
+        empty = backup_dir / 'foo.db.dump.20120104-1200.gz'
+        empty.write_bytes('')
+        assert "unreadable gzip stream" in api.verify([api.get_id(empty)])[api.get_id(empty)]
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_api_load_refuses_corrupt():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        api = backup.DatabaseBackupAPI(mock.Mock(), mock.Mock(), backup_dir)
+        dump_file = backup_dir / 'foo.db.dump.20120101-1200.gz'
+        with mock.patch('pp.db.backup.dump_database', return_value=_write_dump(dump_file)):
+            api.dump()
+        dump_file.write_bytes(dump_file.bytes()[:-20])
+        with mock.patch('pp.db.backup.load_database') as load:
+            with pytest.raises(backup.BackupError):
+                api.load(api.get_id(dump_file))
+            assert not load.called
+            api.load(api.get_id(dump_file), verify=False)
+            assert load.called
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_swap_load_sqlite():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///' + backup_dir / 'test.db')
+        backup_test_db.TestTable.__table__.create(engine)
+        engine.execute(backup_test_db.TestTable.__table__.insert(), id="1", foo="bar")
+        api = backup.DatabaseBackupAPI(engine, dbsetup.Base.metadata, backup_dir)
+        # The checksum is taken as the dump is written, not by reading it back
+        with mock.patch('pp.db.backup.checksum_file', side_effect=AssertionError):
+            dump_file = api.dump()
+        md = json.loads(api._meta_filename(dump_file).text())
+        assert md['checksum'] == backup.checksum_file(dump_file)
+
+        engine.execute(backup_test_db.TestTable.__table__.update(), foo="changed")
+        api.load(api.get_id(dump_file), swap=True)
+        assert engine.execute("select foo from test").fetchall() == [("bar",)]
+        assert not (backup_dir / 'test.db.restore').exists()
+
+        # A dump that fails to load leaves the live database alone
+        bad_dump = _write_dump(backup_dir / 'test.db.dump.20120101-1200.gz', "CREATE TABLE oops (;\n")
+        with pytest.raises(backup.BackupError):
+            backup.swap_load_database(engine, bad_dump)
+        assert engine.execute("select foo from test").fetchall() == [("bar",)]
+        assert not (backup_dir / 'test.db.restore').exists()
     finally:
         shutil.rmtree(backup_dir)
 
 
+def test_backup_progress_counts():
+    updates = []
+    progress = backup.BackupProgress(callback=lambda p: updates.append(p.table), interval=3600)
+    progress.start()
+    lines = ['CREATE TABLE test (id VARCHAR(36), foo VARCHAR(200));\n',
+             "INSERT INTO test VALUES('1','bar');\n",
+             "INSERT INTO test VALUES('2','baz');\n",
+             'COPY public.other (id, foo) FROM stdin;\n',
+             '1\tbar\n',
+             '\\.\n',
+             'COMMIT;\n']
+    for line in lines:
+        progress.line(line)
+    progress.finish()
+    assert progress.rows == 3
+    assert progress.tables == ['test', 'public.other']
+    assert progress.bytes == sum(len(i) for i in lines)
+    assert updates == [None, 'test', 'public.other', 'public.other']
+    stats = progress.as_dict()
+    assert stats['rows'] == 3
+    assert stats['bytes'] == progress.bytes
+
+    progress.cancel()
+    with pytest.raises(backup.BackupCancelled):
+        progress.line('COMMIT;\n')
+
+
+def test_dump_progress_and_cancel_sqlite():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///' + backup_dir / 'test.db')
+        table = backup_test_db.TestTable.__table__
+        table.create(engine)
+        engine.execute(table.insert(), [{'id': str(i), 'foo': 'bar'} for i in range(500)])
+        api = backup.DatabaseBackupAPI(engine, dbsetup.Base.metadata, backup_dir)
+
+        dump_file = api.dump()
+        [restore_point] = api.restore_points
+        stats = restore_point['metadata']['stats']
+        assert stats['rows'] == 500
+        assert stats['tables'] == ['test']
+
+        api.load(restore_point['id'], swap=True)
+        assert json.loads(api._meta_filename(dump_file).text())['load_stats']['rows'] == 500
+
+        def cancel_at_row_100(progress):
+            if progress.rows >= 100:
+                progress.cancel()
+        progress = backup.BackupProgress(callback=cancel_at_row_100, interval=0)
+        dump_file.remove()
+        with pytest.raises(backup.BackupCancelled):
+            api.dump(progress=progress)
+        assert progress.rows == 100
+        assert not backup_dir.files('*.gz') + backup_dir.files('*.partial')
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_table_backup_sqlite():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///' + backup_dir / 'test.db')
+        metadata = sqlalchemy.MetaData()
+        table = backup_test_db.TestTable.__table__.tometadata(metadata)
+        other = sqlalchemy.Table('other', metadata,
+                                 sqlalchemy.Column('id', sqlalchemy.types.Integer, primary_key=True),
+                                 sqlalchemy.Column('foo', sqlalchemy.types.String(200)))
+        metadata.create_all(engine)
+        engine.execute(table.insert(), [{'id': str(i), 'foo': 'bar'} for i in range(10)])
+        engine.execute(other.insert(), id=1, foo='bar')
+        api = backup.DatabaseBackupAPI(engine, metadata, backup_dir)
+
+        with pytest.raises(backup.BackupError):
+            api.dump(tables=['nonesuch'])
+        dump_file = api.dump(tables=[backup_test_db.TestTable])
+        assert '.tables-' in dump_file.basename()
+        [restore_point] = api.restore_points
+        assert restore_point['metadata']['tables'] == ['test']
+        assert restore_point['metadata']['stats']['rows'] == 10
+
+        engine.execute(table.delete().where(table.c.id == '1'))
+        engine.execute(table.update(), foo='changed')
+        engine.execute(other.update(), foo='changed')
+        api.load(restore_point['id'])
+        assert engine.execute("select count(*) from test where foo = 'bar'").scalar() == 10
+        assert engine.execute("select foo from other").fetchall() == [('changed',)]
+
+        # A failed load rolls back, leaving the tables as they were
+        bad_dump = _write_dump(backup_dir / 'test.db.dump.20120101-1200.gz',
+                               "INSERT INTO test VALUES('1','bar');\nCREATE TABLE oops (;\n")
+        with pytest.raises(backup.BackupError):
+            backup.load_tables_database(engine, bad_dump, ['test'])
+        assert engine.execute("select count(*) from test").scalar() == 10
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_table_backup_sqlite_underscore_names():
+    backup_dir = path(tempfile.mkdtemp())
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///' + backup_dir / 'test.db')
+        metadata = sqlalchemy.MetaData()
+        tables = [sqlalchemy.Table(name, metadata,
+                                   sqlalchemy.Column('id', sqlalchemy.types.Integer, primary_key=True),
+                                   sqlalchemy.Column('foo', sqlalchemy.types.String(200), index=True))
+                  for name in ('order_item', 'orderxitem')]
+        metadata.create_all(engine)
+        for table in tables:
+            engine.execute(table.insert(), id=1, foo="bar\nbaz")
+        api = backup.DatabaseBackupAPI(engine, metadata, backup_dir)
+
+        dump_file = api.dump(tables=['order_item'])
+        with gzip.open(dump_file) as fh:
+            assert 'orderxitem' not in fh.read()
+        [restore_point] = api.restore_points
+        assert restore_point['metadata']['stats']['tables'] == ['order_item']
+
+        for table in tables:
+            engine.execute(table.update(), foo='changed')
+        api.load(restore_point['id'])
+        assert engine.execute("select foo from order_item").fetchall() == [("bar\nbaz",)]
+        assert engine.execute("select foo from orderxitem").fetchall() == [('changed',)]
+        # The table's index comes back with it
+        assert [i['name'] for i in sqlalchemy.inspect(engine).get_indexes('order_item')] == ['ix_order_item_foo']
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_rename_databases_retries_while_in_use():
+    in_use = mock.Mock(pgcode='55006')
+    connection = mock.Mock()
+    renames = []
+
+    def execute(statement, **kwargs):
+        if 'RENAME' in str(statement):
+            renames.append(statement)
+            if len(renames) == 1:
+                raise sqlalchemy.exc.OperationalError(statement, {}, in_use)
+    connection.execute.side_effect = execute
+    backup._rename_databases(connection, 'db', 'db_restore', 'db_retired')
+    assert renames == ['ALTER DATABASE "db" RENAME TO "db_retired"'] * 2 + \
+        ['ALTER DATABASE "db_restore" RENAME TO "db"']
+    assert connection.begin.return_value.rollback.call_count == 1
+    assert connection.begin.return_value.commit.call_count == 1
+
+    # Once the timeout has passed the error is raised
+    del renames[:]
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        backup._rename_databases(connection, 'db', 'db_restore', 'db_retired', timeout=0)
+
+
+def test_copy_database_settings():
+    connection = mock.Mock()
+    statements = []
+
+    def execute(statement, **kwargs):
+        statement = str(statement)
+        result = mock.Mock()
+        if 'pg_db_role_setting' in statement:
+            result.fetchall.return_value = [
+                (None, ['work_mem=64MB', 'search_path="$user", public']),
+                ('reporter', ["application_name=it's"])]
+        elif 'aclexplode' in statement:
+            result.fetchall.return_value = [('owner', 'CONNECT', True), ('reporter', 'CONNECT', False)]
+        elif 'pg_database' in statement:
+            result.first.return_value = ('owner', True, "'Live data'")
+        else:
+            statements.append(statement)
+        return result
+    connection.execute.side_effect = execute
+    backup._copy_database_settings(connection, 'db', 'db_restore')
+    assert statements == [
+        'ALTER DATABASE "db_restore" SET work_mem = \'64MB\'',
+        'ALTER DATABASE "db_restore" SET search_path = \'$user\', \'public\'',
+        'ALTER ROLE reporter IN DATABASE "db_restore" SET application_name = \'it\'\'s\'',
+        'REVOKE ALL ON DATABASE "db_restore" FROM PUBLIC',
+        'REVOKE ALL ON DATABASE "db_restore" FROM owner',
+        'GRANT CONNECT ON DATABASE "db_restore" TO owner WITH GRANT OPTION',
+        'GRANT CONNECT ON DATABASE "db_restore" TO reporter',
+        'COMMENT ON DATABASE "db_restore" IS \'Live data\'',
+    ]
@@ -0,0 +1,47 @@
+import json
+import tempfile
+import shutil
+
+from path import path
+
+from pp.db import benchmark, dbsetup
+
+
+def test_run_and_compare():
+    results = benchmark.run(sizes=[20], repeat=2, number=3)
+    assert list(results['results']) == ['{}[20]'.format(i) for i in benchmark.BENCHMARKS]
+    for stats in results['results'].values():
+        assert stats['min'] <= stats['median'] <= stats['max']
+        assert stats['ops_per_sec'] > 0
+    # The populated rows plus those left by crud.add
+    assert results['results']['backup.dump[20]']['rows'] == 20 + 2 * 3
+    assert results['results']['scan.find[20]']['rows'] == 20 + 2 * 3
+    # Column arrays hold the same strings as the tuples do
+    tuple_bytes = results['results']['scan.project.tuple[20]']['bytes_per_row']
+    assert results['results']['scan.project.columns[20]']['bytes_per_row'] > tuple_bytes // 2
+
+    rows = benchmark.compare(results, json.loads(json.dumps(results)))
+    assert [i[0] for i in rows] == list(results['results'])
+    assert all(i[3] == 1.0 for i in rows)
+
+
+def test_main_select_output():
+    workdir = path(tempfile.mkdtemp())
+    try:
+        output = workdir / 'results.json'
+        assert benchmark.main(['--sizes', '10', '--select', 'crud.get', '--select', 'session.*',
+                               '--repeat', '1', '--number', '2', '--output', output]) == 0
+        results = json.loads(output.text())
+        assert sorted(results['results']) == ['crud.get[10]', 'session.create[10]']
+        assert results['meta']['sizes'] == [10]
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_run_leaves_dbsetup_alone():
+    engine, Session = dbsetup.engine, dbsetup.Session
+    modules = dbsetup.registered_modules()
+    benchmark.run(sizes=[5], select=['crud.get'], repeat=1, number=1)
+    assert (dbsetup.engine, dbsetup.Session) == (engine, Session)
+    assert dbsetup.registered_modules() == modules
+    assert not [t for t in dbsetup.Base.metadata.tables if t.startswith('pp_db_bench')]
@@ -0,0 +1,140 @@
+import datetime
+import tempfile
+import shutil
+
+import pytest
+import sqlalchemy
+from path import path
+
+from pp.db import dbsetup, session, utils, cdc
+
+import backup_test_db
+
+
+@pytest.fixture
+def db(request):
+    tmpdir = path(tempfile.mkdtemp())
+    dbsetup.setup(modules=[backup_test_db, cdc])
+    dbsetup.init('sqlite:///' + tmpdir / 'test.db', use_transaction=False)
+    dbsetup.create()
+
+    def cleanup():
+        cdc.stop()
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
+    request.addfinalizer(cleanup)
+
+
+def test_capture_and_read(db):
+    cdc.capture(['test'])
+    add = utils.generic_add(backup_test_db.TestTable)
+    add(id="1", foo="bar")
+    add(id="2", foo="bar")
+    utils.generic_update(backup_test_db.TestTable)("1", foo="baz")
+    utils.generic_update(backup_test_db.TestTable)("2", foo="bar")
+    utils.generic_remove(backup_test_db.TestTable)("2")
+
+    # Rolled back changes leave no events behind
+    add(id="3", foo="bar", no_commit=True)
+    session().flush()
+    session().rollback()
+
+    events = cdc.read_changes()
+    assert [(e.operation, e.pk) for e in events] == [
+        ('insert', ["1"]), ('insert', ["2"]), ('update', ["1"]), ('delete', ["2"])]
+    assert events[0].data == {'id': "1", 'foo': "bar"}
+    assert events[2].data == {'id': "1", 'foo': "baz"}
+    assert events[2].changed == ['foo']
+    assert events[3].data == {'id': "2", 'foo': "bar"}
+    assert set(e.table_name for e in events) == set(['test'])
+
+    batches = list(cdc.iter_changes(events[0].id, batch_size=2))
+    assert [[e.id for e in b] for b in batches] == [[e.id for e in events[1:3]], [events[3].id]]
+    assert cdc.read_changes(events[-1].id) == []
+    assert cdc.read_changes(tables=['other']) == []
+    assert cdc.read_changes(settle=3600) == []
+
+    assert cdc.purge(events[1].id) == 2
+    session().commit()
+    assert [e.id for e in cdc.read_changes()] == [e.id for e in events[2:]]
+
+
+def test_capture_unknown_table(db):
+    with pytest.raises(ValueError):
+        cdc.capture(['nonesuch'])
+    cdc.capture()
+    assert 'test' in cdc._captured
+    assert cdc.Outbox.__tablename__ not in cdc._captured
+
+
+def test_events_in_flush_order(db):
+    cdc.capture(['test'])
+    s = session()
+    keys = ["5", "3", "9", "1", "7"]
+    for key in keys:
+        s.add(backup_test_db.TestTable(id=key, foo="bar"))
+    s.commit()
+    assert [e.pk for e in cdc.read_changes()] == [[key] for key in keys]
+
+
+def test_delete_and_add_same_key(db):
+    cdc.capture(['test'])
+    utils.generic_add(backup_test_db.TestTable)(id="1", foo="old")
+    cursor = cdc.read_changes()[-1].id
+
+    s = session()
+    s.delete(s.query(backup_test_db.TestTable).get("1"))
+    s.add(backup_test_db.TestTable(id="1", foo="new"))
+    s.commit()
+    events = cdc.read_changes(cursor)
+    assert [(e.operation, e.pk, e.data['foo']) for e in events] == [
+        ('delete', ["1"], "old"), ('insert', ["1"], "new")]
+    assert [r.foo for r in s.query(backup_test_db.TestTable)] == ["new"]
+
+
+def sqlite_savepoints(engine):
+    """ Let pysqlite run SAVEPOINTs, by leaving it to SQLAlchemy to BEGIN
+    """
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sqlalchemy.event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+    engine.dispose()
+
+
+def test_events_numbered_at_commit(db, monkeypatch):
+    sqlite_savepoints(dbsetup.engine)
+    cdc.capture(['test'])
+    s = session()
+    s.add(backup_test_db.TestTable(id="1", foo="bar"))
+    s.flush()
+    # Nothing is written until the transaction commits
+    assert s.query(cdc.Outbox).count() == 0
+
+    # Changes rolled back to a savepoint are dropped
+    s.begin_nested()
+    s.add(backup_test_db.TestTable(id="2", foo="bar"))
+    s.flush()
+    s.rollback()
+    s.begin_nested()
+    s.add(backup_test_db.TestTable(id="3", foo="bar"))
+    s.commit()
+
+    committing = datetime.datetime.utcnow()
+    s.commit()
+    events = cdc.read_changes()
+    assert [e.pk for e in events] == [["1"], ["3"]]
+    assert events[0].created == events[1].created >= committing
+
+    # Bulk changes bypass the capture, with a warning
+    warnings = []
+    monkeypatch.setattr(cdc, 'get_log', lambda: type('Log', (), {'warning': staticmethod(warnings.append)}))
+    s.query(backup_test_db.TestTable).filter_by(id="1").update({'foo': "baz"})
+    s.query(backup_test_db.TestTable).filter_by(id="3").delete()
+    s.commit()
+    assert len(cdc.read_changes()) == 2
+    assert warnings == ['Bulk update of test is not captured', 'Bulk delete of test is not captured']
@@ -0,0 +1,83 @@
+import gc
+import os
+import sqlite3
+import tempfile
+import shutil
+import weakref
+
+import sqlalchemy
+from path import path
+
+from pp.db import dbsetup, session, utils
+
+
+def test_fork_gets_new_connections():
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        dbsetup.init('sqlite:///' + tmpdir / 'test.db', use_transaction=False)
+        parent_session = session()
+        parent_connection = parent_session.connection().connection.connection
+        # Leave a second connection idle in the pool for the child to pick up
+        idle = dbsetup.engine.raw_connection()
+        idle_connection = idle.connection
+        idle.close()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child_session = session()
+                child_connection = child_session.connection().connection.connection
+                pooled = dbsetup.engine.raw_connection()
+                ok = (child_session is not parent_session and
+                      child_connection is not parent_connection and
+                      pooled.connection is not idle_connection and
+                      idle_connection in dbsetup._inherited and
+                      parent_session in dbsetup._inherited)
+                os.write(write_fd, b'ok' if ok else b'fail')
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        assert os.read(read_fd, 10) == b'ok'
+        # The parent carries on with its own connection
+        assert session() is parent_session
+        assert parent_session.connection().connection.connection is parent_connection
+    finally:
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
+
+
+class TrackedConnection(sqlite3.Connection):
+    """ A sqlite connection which can be weakly referenced
+    """
+
+
+def test_fork_reinit_keeps_parent_connections():
+    tmpdir = path(tempfile.mkdtemp())
+    engine = sqlalchemy.create_engine('sqlite:///' + tmpdir / 'test.db', poolclass=sqlalchemy.pool.QueuePool,
+                                      connect_args={'factory': TrackedConnection})
+    try:
+        dbsetup.init_with_session(engine, dbsetup.make_session(engine, use_transaction=False))
+        idle = engine.raw_connection()
+        idle_connection = weakref.ref(idle.connection)
+        idle.close()
+        del idle, engine
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # As a process_map worker sets itself up
+                utils._process_init('sqlite:///' + tmpdir / 'child.db', {'use_transaction': False})
+                gc.collect()
+                alive = idle_connection() is not None
+                os.write(write_fd, b'ok' if alive else b'fail')
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        assert os.read(read_fd, 10) == b'ok'
+    finally:
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
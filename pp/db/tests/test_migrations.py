@@ -0,0 +1,140 @@
+import tempfile
+import shutil
+import types
+
+import pytest
+import sqlalchemy
+from path import path
+from sqlalchemy.ext.declarative import declarative_base
+
+from pp.db import dbsetup, migrations
+
+metadata = sqlalchemy.MetaData()
+
+account = sqlalchemy.Table(
+    'account', metadata,
+    sqlalchemy.Column('id', sqlalchemy.types.Integer, primary_key=True),
+    sqlalchemy.Column('name', sqlalchemy.types.String(200)),
+    sqlalchemy.Column('email', sqlalchemy.types.String(200)),
+)
+
+# Declared on its own base so dbsetup.create() only makes the table through
+# the test module's create hook
+Account = type('Account', (declarative_base(),), {'__table__': account, '__tablename__': 'account'})
+
+
+def make_module(declared):
+    mod = types.ModuleType('migrations_test_db')
+    mod.init = lambda: ([], [], [])
+    mod.migrations = lambda: declared
+    return mod
+
+
+def backfill():
+    return migrations.Backfill(2, "Default email", account, {'email': account.c.name + '@example.com'},
+                               where=account.c.email == None, batch_size=10)
+
+
+@pytest.fixture
+def engine(request):
+    tmpdir = path(tempfile.mkdtemp())
+    engine = sqlalchemy.create_engine('sqlite:///' + tmpdir / 'test.db')
+    # The table as it was before the migrations
+    engine.execute("CREATE TABLE account (id INTEGER PRIMARY KEY, name VARCHAR(200))")
+    for i in range(1, 96):
+        engine.execute("INSERT INTO account (id, name) VALUES (?, ?)", i, 'user%d' % i)
+
+    def cleanup():
+        engine.dispose()
+        shutil.rmtree(tmpdir)
+    request.addfinalizer(cleanup)
+    return engine
+
+
+def test_migrate_and_resume_backfill(engine):
+    mod = make_module([
+        migrations.Migration(1, "Add email", "ALTER TABLE account ADD COLUMN email VARCHAR(200)"),
+        backfill(),
+    ])
+    assert [m.version for _, m in migrations.pending([mod], engine)] == [1, 2]
+
+    # Stop part way through the backfill
+    batches = []
+
+    def stop_after_three(name, migration, rows, checkpoint):
+        batches.append((rows, checkpoint))
+        if len(batches) == 3:
+            migrations.time.sleep(0.2)
+
+    done = migrations.migrate([mod], engine, time_limit=0.1, progress=stop_after_three)
+    assert [m.version for _, m in done] == [1]
+    assert batches == [(10, 10), (20, 20), (30, 30)]
+    assert engine.execute("select count(*) from account where email is null").scalar() == 65
+    [(name, pending)] = migrations.pending([mod], engine)
+    assert (name, pending.version) == ('migrations_test_db', 2)
+
+    # Rows changed meanwhile are left alone
+    engine.execute("update account set email = 'own@example.com' where id = 50")
+    del batches[:]
+    done = migrations.migrate([mod], engine, progress=stop_after_three)
+    assert [m.version for _, m in done] == [2]
+    assert batches[0] == (40, 40)
+    assert batches[-1] == (94, 95)
+    assert engine.execute("select email from account where id = 95").scalar() == 'user95@example.com'
+    assert engine.execute("select email from account where id = 50").scalar() == 'own@example.com'
+    assert migrations.pending([mod], engine) == []
+    assert migrations.migrate([mod], engine) == []
+
+
+def test_failed_migration_is_not_recorded(engine):
+    mod = make_module([migrations.Migration(1, "Broken", ["UPDATE account SET name = 'x'", "NOT SQL"])])
+    with pytest.raises(sqlalchemy.exc.DatabaseError):
+        migrations.migrate([mod], engine)
+    assert len(migrations.pending([mod], engine)) == 1
+    assert engine.execute("select count(*) from account where name = 'x'").scalar() == 0
+
+
+def test_declared_checks_versions():
+    mod = make_module([migrations.Migration(2, "Gap", "SELECT 1")])
+    with pytest.raises(migrations.MigrationError):
+        migrations.declared([mod])
+    with pytest.raises(migrations.MigrationError):
+        migrations.Backfill(1, "No key", sqlalchemy.Table('nokey', sqlalchemy.MetaData(),
+                                                          sqlalchemy.Column('x', sqlalchemy.types.Integer)), {})
+
+
+def make_db_module(name, declared):
+    """ A db module owning the account table, which its create hook creates
+    """
+    mod = make_module(declared)
+    mod.__name__ = name
+    mod.init = lambda: ([Account], [], [])
+    mod.create = lambda: account.create(dbsetup.engine, checkfirst=True)
+    return mod
+
+
+def test_create_stamps_new_tables_only():
+    tmpdir = path(tempfile.mkdtemp())
+    mod = make_db_module('migrations_create_db', [
+        migrations.Migration(1, "Add email", "ALTER TABLE account ADD COLUMN email VARCHAR(200)")])
+    try:
+        dbsetup.setup(modules=[mod])
+
+        # A new database gets the latest schema
+        dbsetup.init('sqlite:///' + tmpdir / 'new.db', use_transaction=False)
+        dbsetup.create()
+        assert migrations.pending() == []
+        assert migrations.migrate() == []
+        dbsetup.engine.dispose()
+
+        # An existing database keeps its pending migrations, however often create() runs
+        dbsetup.init('sqlite:///' + tmpdir / 'old.db', use_transaction=False)
+        dbsetup.engine.execute("CREATE TABLE account (id INTEGER PRIMARY KEY, name VARCHAR(200))")
+        dbsetup.create()
+        dbsetup.create()
+        assert [m.version for _, m in migrations.pending([mod])] == [1]
+        assert [m.version for _, m in migrations.migrate([mod])] == [1]
+        dbsetup.engine.execute(account.insert(), id=1, name='user1', email='user1@example.com')
+    finally:
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
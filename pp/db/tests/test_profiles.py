@@ -0,0 +1,69 @@
+import tempfile
+import shutil
+
+import pytest
+import sqlalchemy
+from path import path
+from sqlalchemy.engine.url import make_url
+
+from pp.db import dbsetup, profiles, backup
+
+import backup_test_db
+
+
+def test_get_profile():
+    assert profiles.get_profile(None, 'sqlite://').name == 'default'
+    assert profiles.get_profile('auto', 'sqlite:////tmp/x.db').name == 'sqlite'
+    assert profiles.get_profile('auto', 'postgresql+psycopg2://u:p@localhost/db').name == 'postgresql'
+    assert profiles.get_profile('auto', 'mysql://u:p@localhost/db').name == 'default'
+    with pytest.raises(ValueError):
+        profiles.get_profile('nonesuch', 'sqlite://')
+    with pytest.raises(ValueError):
+        profiles.get_profile('sqlite', 'postgresql://u:p@localhost/db')
+
+
+def test_postgresql_options():
+    url = 'postgresql://u:p@localhost/db'
+    options = profiles.get_profile('postgresql', url).engine_options(make_url(url), {'pool_size': 5})
+    assert options['pool_size'] == 5
+    # Server defaults unless asked for, as older servers refuse unknown settings
+    assert 'connect_args' not in options
+    options = profiles.get_profile('postgresql-timeouts', url).engine_options(make_url(url), {})
+    assert options['connect_args']['options'] == (
+        '-c statement_timeout=30000 -c lock_timeout=10000 -c idle_in_transaction_session_timeout=60000')
+
+
+def test_sqlite_profile():
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        engine = dbsetup.make_engine('sqlite:///' + tmpdir / 'test.db', profile='sqlite')
+        assert isinstance(engine.pool, sqlalchemy.pool.QueuePool)
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert engine.execute('PRAGMA busy_timeout').scalar() == 5000
+        assert engine.execute('PRAGMA synchronous').scalar() == 1
+        engine.dispose()
+
+        engine = dbsetup.make_engine('sqlite://', profile='sqlite-bulk')
+        assert isinstance(engine.pool, sqlalchemy.pool.SingletonThreadPool)
+        assert engine.execute('PRAGMA synchronous').scalar() == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_swap_load_with_wal():
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        engine = dbsetup.make_engine('sqlite:///' + tmpdir / 'test.db', profile='sqlite')
+        table = backup_test_db.TestTable.__table__
+        table.create(engine)
+        engine.execute(table.insert(), id="1", foo="bar")
+        api = backup.DatabaseBackupAPI(engine, dbsetup.Base.metadata, tmpdir)
+        dump_file = api.dump()
+        engine.execute(table.update(), foo="changed")
+        assert (tmpdir / 'test.db-wal').isfile()
+
+        api.load(api.get_id(dump_file), swap=True)
+        assert engine.execute("select foo from test").fetchall() == [("bar",)]
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,216 @@
+import sqlite3
+import tempfile
+import shutil
+import time
+
+import mock
+import pytest
+import sqlalchemy
+import transaction
+from sqlalchemy import exc
+from path import path
+
+from pp.db import dbsetup, session, utils, resilience
+
+import backup_test_db
+
+# Errors the next cursor executes will raise, oldest first. None lets one through.
+faults = []
+
+
+class FaultyCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        if faults:
+            fault = faults.pop(0)
+            if fault is not None:
+                raise fault
+        return sqlite3.Cursor.execute(self, *args)
+
+
+class FaultyConnection(sqlite3.Connection):
+    def cursor(self, factory=FaultyCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def locked():
+    return sqlite3.OperationalError('database is locked')
+
+
+def disconnected():
+    return sqlite3.ProgrammingError('Cannot operate on a closed database.')
+
+
+def make_db(request, use_transaction=False):
+    tmpdir = path(tempfile.mkdtemp())
+    engine = sqlalchemy.create_engine('sqlite:///' + tmpdir / 'test.db',
+                                      poolclass=sqlalchemy.pool.QueuePool,
+                                      connect_args={'factory': FaultyConnection,
+                                                    'check_same_thread': False})
+    dbsetup.init_with_session(engine, dbsetup.make_session(engine, use_transaction))
+    backup_test_db.TestTable.__table__.create(engine)
+    engine.execute(backup_test_db.TestTable.__table__.insert(), id="1", foo="bar")
+
+    def cleanup():
+        del faults[:]
+        transaction.abort()
+        dbsetup.Session.remove()
+        engine.dispose()
+        shutil.rmtree(tmpdir)
+    request.addfinalizer(cleanup)
+    return engine
+
+
+@pytest.fixture
+def db(request):
+    return make_db(request)
+
+
+@pytest.fixture
+def zope_db(request):
+    return make_db(request, use_transaction=True)
+
+
+def test_is_transient():
+    assert resilience.is_transient(exc.OperationalError('select', {}, locked()))
+    assert not resilience.is_transient(exc.IntegrityError('insert', {}, sqlite3.IntegrityError('UNIQUE')))
+    assert resilience.is_transient(exc.DBAPIError('select', {}, Exception(), connection_invalidated=True))
+    assert resilience.is_transient(exc.OperationalError('select', {}, mock.Mock(pgcode='40001')))
+    assert not resilience.is_transient(ValueError())
+
+
+def test_retry_transient(db):
+    guard = resilience.Resilience(attempts=3, backoff=0.001)
+    get = guard(utils.generic_get(backup_test_db.TestTable))
+    faults.extend([locked(), disconnected()])
+    assert get("1").foo == "bar"
+    assert not faults
+    assert guard.breaker.state == 'closed'
+
+    faults.extend([locked()] * 3)
+    with pytest.raises(exc.OperationalError):
+        get("1")
+    assert guard.breaker.failures == 1
+
+
+def test_no_retry_for_other_errors(db):
+    guard = resilience.Resilience(attempts=3, backoff=0.001)
+    get = mock.Mock(side_effect=utils.DBGetError("not found"))
+    with pytest.raises(utils.DBGetError):
+        guard(get)("2")
+    assert get.call_count == 1
+    assert guard.breaker.failures == 0
+
+
+def test_circuit_breaker(db):
+    guard = resilience.Resilience(attempts=1, failure_threshold=2, reset_timeout=0.1)
+    has = guard(utils.generic_has(backup_test_db.TestTable))
+    faults.extend([locked()] * 2)
+    for _ in range(2):
+        with pytest.raises(exc.OperationalError):
+            has("1")
+    assert guard.breaker.state == 'open'
+
+    faults.append(locked())
+    with pytest.raises(resilience.CircuitOpenError):
+        has("1")
+    assert len(faults) == 1
+
+    time.sleep(0.1)
+    assert guard.breaker.state == 'half-open'
+    # The trial call fails, so the circuit opens again
+    with pytest.raises(exc.OperationalError):
+        has("1")
+    assert guard.breaker.state == 'open'
+    time.sleep(0.1)
+    assert has("1")
+    assert guard.breaker.state == 'closed'
+
+
+def test_deadline(db):
+    resilience.install(db, pre_ping=False)
+    guard = resilience.Resilience(timeout=0.1)
+    forever = guard(lambda: session().execute(
+        "with recursive r(i) as (select 1 union all select i + 1 from r) select count(*) from r").scalar())
+    started = time.time()
+    with pytest.raises(resilience.DeadlineExceeded):
+        forever()
+    assert time.time() - started < 1
+    assert guard.breaker.failures == 1
+    # Statements outside a deadline run normally
+    assert session().execute("select count(*) from test").scalar() == 1
+
+
+# (cursor, statement) run through RecordingCursor, with SET statements only recorded
+executed = []
+
+
+class RecordingCursor(sqlite3.Cursor):
+    def execute(self, statement, *args):
+        executed.append((self, statement))
+        if statement.startswith('SET'):
+            return self
+        return sqlite3.Cursor.execute(self, statement, *args)
+
+
+class RecordingConnection(sqlite3.Connection):
+    def cursor(self, factory=RecordingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def test_postgresql_deadline_set_once_per_transaction(tmpdir):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % tmpdir.join('test.db'),
+                                      connect_args={'factory': RecordingConnection})
+    # Install the postgresql hooks, which only need the statements to be run
+    engine.dialect.name = 'postgresql'
+    try:
+        resilience.install(engine, pre_ping=False)
+    finally:
+        del engine.dialect.name
+    del executed[:]
+    with resilience.deadline(10):
+        with engine.begin() as connection:
+            for _ in range(3):
+                connection.execute("select 1")
+        with engine.begin() as connection:
+            connection.execute("select 1")
+    sets = [(c, st) for c, st in executed if st.startswith('SET')]
+    assert [st.split('=')[0] for c, st in sets] == ['SET LOCAL statement_timeout '] * 2
+    # Each SET has a cursor of its own
+    statement_cursors = [c for c, st in executed if not st.startswith('SET')]
+    assert not [c for c, st in sets if c in statement_cursors]
+
+    # A deadline ending within a transaction puts the default back
+    del executed[:]
+    with engine.begin() as connection:
+        with resilience.deadline(10):
+            connection.execute("select 1")
+        connection.execute("select 1")
+        connection.execute("select 1")
+    assert [st for c, st in executed if st.startswith('SET')][1] == 'SET LOCAL statement_timeout TO DEFAULT'
+    assert len([st for c, st in executed if st.startswith('SET')]) == 2
+    engine.dispose()
+
+
+def test_pre_ping(db):
+    resilience.install(db)
+    dbsetup.Session.remove()
+    faults.append(disconnected())
+    assert session().execute("select count(*) from test").scalar() == 1
+    assert not faults
+
+
+def test_retry_with_zope_transaction(zope_db):
+    guard = resilience.Resilience(attempts=3, backoff=0.001)
+    add = utils.generic_add(backup_test_db.TestTable)
+
+    def add_two(i):
+        add(id=str(i), foo="bar", no_commit=True)
+        session().flush()
+        add(id=str(i + 1), foo="bar", no_commit=True)
+        session().flush()
+    # The first attempt fails after the first row is written
+    faults.extend([None, locked()])
+    guard(add_two)(2)
+    assert not faults
+    transaction.commit()
+    assert zope_db.execute("select id from test order by id").fetchall() == [("1",), ("2",), ("3",)]
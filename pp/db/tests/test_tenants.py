@@ -0,0 +1,147 @@
+import tempfile
+import shutil
+import threading
+
+import pytest
+import transaction
+from path import path
+
+from pp.db import dbsetup, tenants, session, engine
+
+import backup_test_db
+
+
+@pytest.fixture
+def tenant_dir(request):
+    tmpdir = path(tempfile.mkdtemp())
+
+    def cleanup():
+        if dbsetup.engines is not None:
+            dbsetup.engines.dispose()
+        dbsetup.engines = None
+        shutil.rmtree(tmpdir)
+    request.addfinalizer(cleanup)
+    return tmpdir
+
+
+def test_tenant_routing(tenant_dir):
+    registry = dbsetup.init_registry(resolver=lambda name: 'sqlite:///' + tenant_dir / name + '.db',
+                                     use_transaction=False)
+    assert tenants.current_tenant() is None
+    for name in ('a', 'b'):
+        with tenants.tenant(name):
+            assert tenants.current_tenant() == name
+            backup_test_db.TestTable.__table__.create(engine())
+
+    with tenants.tenant('a'):
+        s = session()
+        s.add(backup_test_db.TestTable(id="1", foo="bar"))
+        s.commit()
+        with tenants.tenant('b'):
+            assert session().query(backup_test_db.TestTable).count() == 0
+            assert engine() is registry.engine('b')
+        assert session().query(backup_test_db.TestTable).count() == 1
+    assert tenants.current_tenant() is None
+    assert sorted(registry.names()) == ['a', 'b']
+
+    with pytest.raises(tenants.TenantError):
+        tenants.EngineRegistry().engine('unknown')
+
+
+def test_lru_eviction(tenant_dir):
+    registry = tenants.EngineRegistry(max_engines=2, use_transaction=False)
+    for name in ('a', 'b', 'c'):
+        registry.register(name, 'sqlite:///' + tenant_dir / name + '.db')
+    registry.engine('a')
+    registry.engine('b')
+    registry.engine('a')
+    registry.engine('c')
+    assert registry.names() == ['a', 'c']
+
+    assert registry.prune(max_idle=0) == ['a', 'c']
+    assert len(registry) == 0
+
+
+def test_bounded_connections(tenant_dir):
+    registry = tenants.EngineRegistry(max_engines=2, max_connections=4, pool_timeout=0.1,
+                                      use_transaction=False)
+    for name in ('a', 'b', 'c'):
+        registry.register(name, 'sqlite:///' + tenant_dir / name + '.db')
+    assert registry.pool_size == 2 and registry.pool_max_overflow == 0
+
+    busy = [registry.engine(name).connect() for name in ('a', 'b')]
+    with pytest.raises(tenants.RegistryFullError):
+        registry.engine('c')
+
+    # Once an engine's connections are returned it can be evicted
+    busy[0].close()
+    registry.engine('c')
+    assert registry.names() == ['b', 'c']
+    busy[1].close()
+
+
+def test_wait_for_idle_engine(tenant_dir):
+    registry = tenants.EngineRegistry(max_engines=2, max_connections=4, pool_timeout=5,
+                                      use_transaction=False)
+    for name in ('a', 'b', 'c'):
+        registry.register(name, 'sqlite:///' + tenant_dir / name + '.db')
+    busy = [registry.engine(name).connect() for name in ('a', 'b')]
+
+    # Open engines are looked up without the lock
+    lock, registry._lock = registry._lock, None
+    assert registry.engine('a') is registry.engine('a')
+    registry._lock = lock
+
+    # A connection checked in from another thread makes room
+    threading.Timer(0.2, busy[1].close).start()
+    registry.engine('c')
+    assert registry.names() == ['a', 'c']
+    assert registry._waiting == 0
+    busy[0].close()
+
+
+def test_more_engines_than_connections(tenant_dir):
+    registry = tenants.EngineRegistry(max_engines=10, max_connections=4, pool_timeout=0.1,
+                                      use_transaction=False)
+    assert registry.max_engines == 4 and registry.pool_size == 1
+    names = [str(i) for i in range(5)]
+    for name in names:
+        registry.register(name, 'sqlite:///' + tenant_dir / name + '.db')
+    busy = [registry.engine(name).connect() for name in names[:4]]
+    with pytest.raises(tenants.RegistryFullError):
+        registry.engine(names[4])
+    assert sum(registry.engine(name).pool.checkedout() for name in registry.names()) == 4
+    for connection in busy:
+        connection.close()
+
+
+def test_tenant_with_zope_transaction(tenant_dir):
+    registry = dbsetup.init_registry(resolver=lambda name: 'sqlite:///' + tenant_dir / name + '.db')
+    backup_test_db.TestTable.__table__.create(registry.engine('a'))
+    with tenants.tenant('a'):
+        session().add(backup_test_db.TestTable(id="1", foo="bar"))
+        session().flush()
+    # The session outlives the block until the transaction ends
+    transaction.commit()
+    assert registry.engine('a').execute("select count(*) from test").scalar() == 1
+    assert registry.engine('a').pool.checkedout() == 0
+
+    with tenants.tenant('a'):
+        session().add(backup_test_db.TestTable(id="2", foo="bar"))
+        session().flush()
+    transaction.abort()
+    assert registry.engine('a').execute("select count(*) from test").scalar() == 1
+    assert registry.engine('a').pool.checkedout() == 0
+
+
+def test_after_fork_sets_engines_aside(tenant_dir):
+    registry = tenants.EngineRegistry(use_transaction=False)
+    registry.register('a', 'sqlite:///' + tenant_dir / 'a.db')
+    parent = registry.engine('a')
+    inherited = []
+    registry.after_fork(inherited)
+    assert len(registry) == 0
+    assert [e.engine for e in inherited] == [parent]
+    # The child gets an engine of its own
+    assert registry.engine('a') is not parent
+    parent.dispose()
@@ -0,0 +1,63 @@
+import tempfile
+import shutil
+
+from path import path
+
+from pp.db import dbsetup, session, utils
+
+import backup_test_db
+
+
+def add_batch(ids):
+    add = utils.generic_add(backup_test_db.TestTable)
+    for i in ids:
+        add(id=str(i), foo="bar", no_commit=True)
+    return len(ids)
+
+
+def test_process_map():
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        dbsetup.setup(modules=[backup_test_db])
+        dbsetup.init('sqlite:///' + tmpdir / 'test.db', use_transaction=False)
+        dbsetup.create()
+        batches = [range(i, i + 10) for i in range(0, 100, 10)]
+        assert utils.process_map(add_batch, batches, processes=4) == [10] * 10
+        assert session().query(backup_test_db.TestTable).count() == 100
+    finally:
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
+
+
+def test_generic_project():
+    tmpdir = path(tempfile.mkdtemp())
+    try:
+        dbsetup.setup(modules=[backup_test_db])
+        dbsetup.init('sqlite:///' + tmpdir / 'test.db', use_transaction=False)
+        dbsetup.create()
+        add_batch(range(25))
+        utils.generic_update(backup_test_db.TestTable)("3", foo="baz")
+
+        rows = utils.generic_project(backup_test_db.TestTable, ['id', 'foo'])(foo="baz")
+        assert rows == [("3", "baz")]
+        assert rows[0].id == "3" and rows[0].foo == "baz"
+
+        [record] = utils.generic_project(backup_test_db.TestTable, ['foo', 'id'], 'record')(id="3")
+        assert (record.foo, record.id) == ("baz", "3")
+        assert not hasattr(record, '__dict__')
+        assert list(record) == ["baz", "3"]
+
+        columns = utils.generic_project(backup_test_db.TestTable, ['id', 'foo'], 'columns')()
+        assert list(columns) == ['id', 'foo']
+        assert sorted(columns['id']) == sorted(str(i) for i in range(25))
+        assert len(utils.generic_project(backup_test_db.TestTable, ['id'], 'columns')(foo='x')['id']) == 0
+
+        project_batches = utils.generic_project_batches(backup_test_db.TestTable, ['id'], batch_size=10)
+        batches = list(project_batches(foo="bar"))
+        assert [len(b) for b in batches] == [10, 10, 4]
+        assert session().identity_map.keys() == []
+    finally:
+        dbsetup.Session.remove()
+        dbsetup.engine.dispose()
+        shutil.rmtree(tmpdir)
@@ -13,12 +13,23 @@
 The :mod:`pp.db.utils` module contains some commonly functions.
 """
 
+import collections
 import logging
+import multiprocessing
+
+import transaction
+from sqlalchemy.sql import select, and_
 
 #from sqlalchemy.orm import eagerload
 #from sqlalchemy.sql import select, func, and_
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from pp.db import session
+from pp.db import dbsetup
 
 
 def get_log():
@@ -194,3 +205,192 @@ def generic_remove(obj, id_attr='id'):
             s.commit()
 
     return remove
+
+
+# -------------- Projection Methods ---------------- #
+
+def record_class(name, fields):
+    """
+    Returns a minimal class with __slots__ for the given field names, lighter
+    than a namedtuple when rows are built and discarded in bulk.
+    """
+    fields = tuple(fields)
+
+    def __init__(self, *values):
+        for field, value in zip(fields, values):
+            setattr(self, field, value)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (name, ', '.join('%s=%r' % (f, getattr(self, f)) for f in fields))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    return type(str(name), (object,), {
+        '__slots__': fields,
+        '_fields': fields,
+        '__init__': __init__,
+        '__iter__': __iter__,
+        '__repr__': __repr__,
+        '__eq__': __eq__,
+        '__ne__': __ne__,
+    })
+
+
+def _projection(obj, columns, rows):
+    """
+    Build the select statement and row converter shared by the project methods.
+    """
+    if rows not in ('tuple', 'record', 'columns'):
+        raise ValueError("rows must be 'tuple', 'record' or 'columns', not %r" % rows)
+    mapped = obj.__mapper__.columns
+    cols = [mapped[c] for c in columns]
+    name = '%sRow' % obj.__name__
+
+    if rows == 'tuple':
+        make = collections.namedtuple(name, columns)._make
+        convert = lambda result: [make(r) for r in result]
+    elif rows == 'record':
+        cls = record_class(name, columns)
+        convert = lambda result: [cls(*r) for r in result]
+    else:
+        def convert(result):
+            arrays = list(zip(*result)) if result else [()] * len(columns)
+            if numpy is not None:
+                arrays = [numpy.array(a) for a in arrays]
+            else:
+                arrays = [list(a) for a in arrays]
+            return collections.OrderedDict(zip(columns, arrays))
+
+    def query(kwargs):
+        return select(cols).where(and_(*[mapped[k] == v for k, v in kwargs.items()]))
+
+    return query, convert
+
+
+def generic_project(obj, columns, rows='tuple'):
+    """Returns a generic 'project' DB method.
+
+    This is a fast path for reading a few attributes from many rows. The given
+    columns are selected straight from the cursor, skipping the ORM identity
+    map and instrumentation.
+
+    :param obj: This is the SQLAlchemy Mapper / Declaritive base class to use.
+
+    :param columns: list of mapped attribute names to select.
+
+    :param rows: 'tuple' for named tuples, 'record' for :func:`record_class`
+    instances or 'columns' for a dict of column name to NumPy array (or list
+    when NumPy is not installed).
+
+    :returns: A project function which allows filtering by provided key
+    word arguments, like generic_find.
+
+    """
+    query, convert = _projection(obj, columns, rows)
+
+    def project(**kwargs):
+        """Project %s columns %s filtered by keyword arguments.""" % (obj, columns)
+        return convert(session().execute(query(kwargs)).fetchall())
+    return project
+
+
+def generic_project_batches(obj, columns, batch_size=10000, rows='tuple'):
+    """Returns a generic batched 'project' DB method.
+
+    As generic_project, but the returned function is a generator yielding
+    batches of at most batch_size rows (or column arrays), so memory use
+    stays flat however many rows match. Results are streamed from a server
+    side cursor where the database supports it.
+
+    """
+    query, convert = _projection(obj, columns, rows)
+
+    def project_batches(**kwargs):
+        """Project %s columns %s in batches, filtered by keyword arguments.""" % (obj, columns)
+        result = session().execute(query(kwargs).execution_options(stream_results=True))
+        try:
+            while True:
+                batch = result.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield convert(batch)
+        finally:
+            result.close()
+    return project_batches
+
+
+# -------------- Process Pool Methods ---------------- #
+
+# Set in each pool worker by _process_init
+_process_use_transaction = False
+
+
+def _process_init(uri, init_kwargs):
+    """
+    Pool worker initialiser: set up an engine and session of its own.
+    """
+    global _process_use_transaction
+    dbsetup.after_fork()
+    dbsetup.init(uri, **init_kwargs)
+    _process_use_transaction = init_kwargs.get('use_transaction', True)
+
+
+def _process_call(args):
+    """
+    Run one item of work in a pool worker, committing on success.
+    """
+    func, item = args
+    s = session()
+    try:
+        result = func(item)
+        if _process_use_transaction:
+            transaction.commit()
+        else:
+            s.commit()
+        return result
+    except Exception:
+        if _process_use_transaction:
+            transaction.abort()
+        else:
+            s.rollback()
+        raise
+    finally:
+        dbsetup.Session.remove()
+
+
+def process_map(func, items, uri=None, processes=None, chunksize=1, **init_kwargs):
+    """Run bulk database work across a pool of processes, each with its own engine.
+
+    Each worker calls :func:`pp.db.dbsetup.init` for itself, so the generic CRUD
+    methods can be used inside `func` as usual. The work for each item is
+    committed when `func` returns, or rolled back if it raises.
+
+    :param func: module level function (so it can be pickled) called with each item.
+    Pass batches of rows as items to amortise the commit.
+
+    :param uri: database URI, defaults to the one passed to `dbsetup.init`.
+
+    :param processes: number of worker processes, defaults to the CPU count.
+
+    :param init_kwargs: passed to `dbsetup.init` in each worker, pool_size=1 by default.
+
+    :returns: list of the results of `func` for each item, in order.
+
+    """
+    if uri is None:
+        assert dbsetup.engine, "Please setup the database or pass a uri to process_map"
+        uri = str(dbsetup.engine.url)
+    init_kwargs.setdefault('pool_size', 1)
+    pool = multiprocessing.Pool(processes, _process_init, (uri, init_kwargs))
+    try:
+        return pool.map(_process_call, [(func, item) for item in items], chunksize)
+    finally:
+        pool.close()
+        pool.join()
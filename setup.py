@@ -42,6 +42,8 @@ PackageData = {
 }
 
 EntryPoints = """
+[console_scripts]
+pp-db-benchmark = pp.db.benchmark:main
 """
 
 setup(